@@ -7,20 +7,47 @@ import json
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
-import pandas_redshift as pr
+import boto3
+import psycopg2
 import reverse_geocoder as rg
 import os
-import sys
+import shutil
+import re
+import sqlite3
+import time
+import socket
+import resource
+import threading
+import contextlib
+import zlib
+import asyncio
+import itertools
+import collections
+import csv
+import gzip
+import io
+import tempfile
+import functools
+import abc
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
 from dateutil.parser import parse
+# ijson (event based json parser) is optional, it enables streaming ingestion
+try:
+    import ijson
+except ImportError:
+    ijson = None
 #Airflow dependencies
 import airflow
 from airflow import DAG
 from airflow.utils.db import provide_session
 from airflow.models import Variable
 from airflow.models import XCom
+from airflow.exceptions import AirflowSkipException
 from airflow.decorators import task
 from airflow.utils.task_group import TaskGroup
-from airflow.operators.python_operator import PythonOperator
+from airflow.operators.python_operator import PythonOperator, BranchPythonOperator
 
 def convert_datetime(date: str):
     """
@@ -32,263 +59,1608 @@ def convert_datetime(date: str):
         return parse(str(date)).replace(tzinfo=None)
     return parse(date).replace(tzinfo=None)
 
+def datetime_dimension(report_end, dedupe=True):
+    """
+    - vectorized convert_datetime for a whole column of RFC3339 strings
+    - the utc offset is dropped without shifting the time, like convert_datetime
+    - builds the date, year, month, day and time columns in one pass
+    - with dedupe every distinct timestamp is parsed once and mapped back to its rows
+    return: dataframe with the dimension columns, aligned with report_end
+    """
+    if dedupe:
+        # many reports share the same end time
+        codes, uniques = pd.factorize(report_end)
+        dimension = datetime_dimension(pd.Series(uniques, dtype=object), dedupe=False)
+        return dimension.reindex(codes).reset_index(drop=True)
+    report_end = report_end.reset_index(drop=True)
+    text = report_end.astype("string").str.replace(
+        r"(T\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)(?:Z|[+-]\d{2}:?\d{2})$", r"\1", regex=True)
+    parsed = pd.to_datetime(text, errors="coerce")
+    # anything the vectorized parser could not read goes through dateutil
+    failed = parsed.isna() & report_end.notna()
+    if failed.any():
+        parsed[failed] = report_end[failed].map(convert_datetime)
+    # nullable integers, a report without end time must not turn the columns into floats
+    return pd.DataFrame({"date": parsed.dt.strftime('%Y-%m-%d'),
+                         "year": parsed.dt.year.astype("Int64"),
+                         "month": parsed.dt.month.astype("Int64"),
+                         "day": parsed.dt.day.astype("Int64"),
+                         "time": parsed.dt.time})
+
+class StageMetrics:
+    """
+    - metrics of one run of a DAG callable: wall time, cpu time, peak memory,
+      rows in/out, serialized bytes and latency of the external calls
+    - counters and timers can be updated from the loader staging threads
+    """
+    def __init__(self, stage, shard=None):
+        self.stage = stage
+        self.shard = shard
+        self.counters = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.timings[name] = self.timings.get(name, 0) + elapsed
+
+# metrics of the DAG callable running in this process, set by instrumented()
+active_metrics = None
+
+def count_metric(name, value):
+    """
+    - add value to the counter name of the running stage (no-op outside a stage)
+    """
+    if active_metrics is not None:
+        active_metrics.count(name, value)
+
+def timed_call(name):
+    """
+    - time an external call (http fetch, geocoder, upload, COPY) of the running stage
+    return: context manager
+    """
+    if active_metrics is None:
+        return contextlib.nullcontext()
+    return active_metrics.timer(name)
+
+def emit_metrics(record):
+    """
+    - send the metrics of a stage to the sinks listed in the WOW_METRICS_SINKS variable
+      (comma separated):
+        log                 - one json line in the task log
+        file:///path.jsonl  - one json line appended to a file read by a local collector
+        statsd://host:port  - StatsD line protocol over udp
+    - a failing sink never fails the task, nor replaces the exception of a failed task
+    """
+    try:
+        sinks = Variable.get("WOW_METRICS_SINKS", default_var="log")
+    except Exception as error:
+        # the metadata database can be the reason the task failed
+        print("Could not read the metrics sinks:", error)
+        return
+    for sink in [sink.strip() for sink in sinks.split(",") if sink.strip()]:
+        try:
+            if sink == "log":
+                print("stage metrics:", json.dumps(record))
+            elif sink.startswith("file://"):
+                with open(urllib.parse.urlparse(sink).path, "a") as outfile:
+                    outfile.write(json.dumps(record) + "\n")
+            elif sink.startswith("statsd://"):
+                address = urllib.parse.urlparse(sink)
+                prefix = "wow_etl." + record["stage"]
+                lines = []
+                for name, value in record.items():
+                    if name.endswith("_seconds"):
+                        lines.append("{}.{}:{}|ms".format(prefix, name[:-len("_seconds")], round(value * 1000, 3)))
+                    elif name.endswith("_bytes") and name.startswith("peak"):
+                        lines.append("{}.{}:{}|g".format(prefix, name, value))
+                    elif isinstance(value, (int, float)) and not isinstance(value, bool) and name != "shard":
+                        lines.append("{}.{}:{}|c".format(prefix, name, value))
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.sendto("\n".join(lines).encode(), (address.hostname, address.port or 8125))
+            else:
+                print("Unknown metrics sink:", sink)
+        except OSError as error:
+            print("Could not emit metrics to", sink, error)
+
+def instrumented(callable):
+    """
+    - wrap a DAG callable to record the metrics of each of its runs
+    - peak memory is the peak RSS of the task process (each task runs in its own process)
+    return: wrapped callable
+    """
+    @functools.wraps(callable)
+    def wrapper(*args, **kwargs):
+        global active_metrics
+        metrics = StageMetrics(callable.__name__, kwargs.get("shard"))
+        previous, active_metrics = active_metrics, metrics
+        status = "failed"
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            value = callable(*args, **kwargs)
+            status = "success"
+            return value
+        except AirflowSkipException:
+            status = "skipped"
+            raise
+        finally:
+            active_metrics = previous
+            record = {"stage": metrics.stage,
+                      "shard": metrics.shard,
+                      "run_id": kwargs.get("run_id"),
+                      "status": status,
+                      "wall_seconds": round(time.perf_counter() - start_wall, 6),
+                      "cpu_seconds": round(time.process_time() - start_cpu, 6),
+                      # ru_maxrss is in kilobytes on linux
+                      "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+            record.update(metrics.counters)
+            record.update({name + "_seconds": round(value, 6) for name, value in metrics.timings.items()})
+            emit_metrics(record)
+    return wrapper
+
+class ArtifactStore(abc.ABC):
+    """
+    - base class of the artifact store used to pass data between tasks
+    - every stage writes its table once to the store and only a small
+      reference (uri, format, schema, row count) is pushed to xcom
+    - downstream tasks read back only the columns they need
+    """
+    @abc.abstractmethod
+    def write_table(self, df, dag_id, run_id, name):
+        pass
+
+    @abc.abstractmethod
+    def read_table(self, ref, columns=None):
+        pass
+
+    @abc.abstractmethod
+    def write_raw(self, data, dag_id, run_id, name):
+        pass
+
+    @abc.abstractmethod
+    def open_raw(self, ref):
+        pass
+
+    @abc.abstractmethod
+    def write_records(self, records, dag_id, run_id, name, chunk_size):
+        pass
+
+    @abc.abstractmethod
+    def iter_records(self, ref):
+        pass
+
+    @abc.abstractmethod
+    def delete_run(self, dag_id, run_id):
+        pass
+
+    def to_arrow(self, df):
+        """
+        - convert dataframe to arrow table
+        - json_normalize can leave object columns with mixed value types,
+          those columns are stored as strings instead of failing the task
+        return: pyarrow Table
+        """
+        try:
+            return pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+        arrays = []
+        for col in df.columns:
+            try:
+                arrays.append(pa.array(df[col], from_pandas=True))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                arrays.append(pa.array(df[col].where(df[col].isna(), df[col].astype(str)), from_pandas=True))
+        return pa.Table.from_arrays(arrays, names=[str(col) for col in df.columns])
+
+class LocalArtifactStore(ArtifactStore):
+    """
+    - local filesystem backend of the artifact store
+    - tables are written as Arrow IPC files (or Parquet) under <root>/<dag_id>/<run_id>/
+    - Arrow IPC files are memory-mapped on read so column selection is zero-copy
+    """
+    extensions = {"arrow": ".arrow", "parquet": ".parquet"}
+
+    def __init__(self, root, table_format="arrow"):
+        if table_format not in self.extensions:
+            raise ValueError("Unsupported artifact format: " + str(table_format))
+        self.root = root
+        self.table_format = table_format
+
+    def run_dir(self, dag_id, run_id):
+        # run ids look like "scheduled__2022-07-28T00:00:00+00:00", keep them path safe
+        path = os.path.join(self.root, dag_id, re.sub("[^A-Za-z0-9_.-]+", "_", run_id))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def write_table(self, df, dag_id, run_id, name):
+        path = os.path.join(self.run_dir(dag_id, run_id), name + self.extensions[self.table_format])
+        table = self.to_arrow(df)
+        if self.table_format == "parquet":
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(path, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        return {"uri": path,
+                "format": self.table_format,
+                "schema": {field.name: str(field.type) for field in table.schema},
+                "num_rows": table.num_rows,
+                "num_bytes": os.path.getsize(path)}
+
+    def read_table(self, ref, columns=None):
+        if ref["format"] == "parquet":
+            table = pq.read_table(ref["uri"], columns=columns, memory_map=True)
+        else:
+            # memory map the file, arrow buffers point straight into the page cache,
+            # the mapping outlives the closed handle as long as the buffers use it
+            with pa.memory_map(ref["uri"], "r") as source:
+                table = pa.ipc.open_file(source).read_all()
+            if columns is not None:
+                table = table.select(columns)
+        return table.to_pandas()
+
+    def write_raw(self, data, dag_id, run_id, name):
+        path = os.path.join(self.run_dir(dag_id, run_id), name)
+        with open(path, "wb") as outfile:
+            outfile.write(data)
+        return {"uri": path, "format": "raw", "num_bytes": len(data)}
+
+    def open_raw(self, ref):
+        return open(ref["uri"], "rb")
+
+    def write_records(self, records, dag_id, run_id, name, chunk_size):
+        """
+        - write an iterable of json records as newline delimited json
+        - a new part file is started every chunk_size records so only one
+          record is held in memory at a time
+        """
+        path = os.path.join(self.run_dir(dag_id, run_id), name)
+        os.makedirs(path, exist_ok=True)
+        parts = []
+        num_rows = 0
+        outfile = None
+        for record in records:
+            if num_rows % chunk_size == 0:
+                if outfile is not None:
+                    outfile.close()
+                parts.append(os.path.join(path, "part-%05d.ndjson" % len(parts)))
+                outfile = open(parts[-1], "w")
+            outfile.write(json.dumps(record))
+            outfile.write("\n")
+            num_rows += 1
+        if outfile is not None:
+            outfile.close()
+        return {"uri": path, "format": "ndjson", "parts": parts, "num_rows": num_rows,
+                "num_bytes": sum(os.path.getsize(part) for part in parts)}
+
+    def iter_records(self, ref):
+        for part in ref["parts"]:
+            with open(part) as infile:
+                for line in infile:
+                    yield json.loads(line)
+
+    def delete_run(self, dag_id, run_id):
+        shutil.rmtree(self.run_dir(dag_id, run_id), ignore_errors=True)
+
+# artifact store backends, selected by the scheme of the WOW_ARTIFACT_STORE variable
+ARTIFACT_BACKENDS = {"file": LocalArtifactStore}
+
+def get_artifact_store():
+    """
+    - build the artifact store configured in the WOW_ARTIFACT_STORE variable
+      e.g. "file:///opt/airflow/artifacts" or "file:///data/wow?format=parquet"
+    return: ArtifactStore object
+    """
+    uri = urllib.parse.urlparse(Variable.get("WOW_ARTIFACT_STORE",
+                                             default_var="file:///tmp/wow_artifacts"))
+    if uri.scheme not in ARTIFACT_BACKENDS:
+        raise ValueError("Unsupported artifact store: " + uri.scheme)
+    options = dict(urllib.parse.parse_qsl(uri.query))
+    return ARTIFACT_BACKENDS[uri.scheme](uri.path,
+                                         table_format=options.get("format", "arrow"))
+
+def write_table(context, name, df):
+    """
+    - write the dataframe of this DAG run to the artifact store
+    return: reference dictionary
+    """
+    ref = get_artifact_store().write_table(df, context["dag"].dag_id, context["run_id"], name)
+    count_metric("rows_out", ref["num_rows"])
+    count_metric("bytes_written", ref["num_bytes"])
+    return ref
+
+def read_table(ref, columns=None):
+    """
+    - read a table of the artifact store from its reference
+    return: pandas dataframe
+    """
+    df = get_artifact_store().read_table(ref, columns=columns)
+    count_metric("rows_in", len(df))
+    count_metric("bytes_read", ref["num_bytes"])
+    return df
+
+def shard_name(key, shard):
+    """
+    - name of the artifact holding one shard of a stage table
+    return: string
+    """
+    return "{}-{:03d}".format(key, shard)
+
+def pull_shard(context, key, shard, columns=None):
+    """
+    - read one shard of an extracted table, the references of every shard
+      are pushed by extract_features under the extract_shards key
+    return: pandas dataframe
+    """
+    ref = context["ti"].xcom_pull(key='extract_shards')[shard][key]
+    return read_table(ref, columns=columns)
+
+def pull_mapped(context, task_id, shard, columns=None):
+    """
+    - read the table returned by the mapped task instance of task_id handling shard
+    return: pandas dataframe
+    """
+    ref = context["ti"].xcom_pull(task_ids=task_id, map_indexes=shard)
+    return read_table(ref, columns=columns)
+
+def pull_features(context, key):
+    """
+    - pull the raw payload reference pushed under key from xcom
+    - iterate over the GeoJSON features stored in the artifact store, either
+      chunk by chunk (streaming ingestion) or from the whole document
+    return: iterator of feature dictionaries
+    """
+    store = get_artifact_store()
+    ref = context["ti"].xcom_pull(key=key)
+    count_metric("bytes_read", ref.get("num_bytes", 0))
+    return iter_stored_features(store, ref)
+
+def iter_stored_features(store, ref):
+    """
+    - iterate over the features of a stored payload reference, the features of a
+      partitioned fetch are chained partition after partition
+    return: iterator of feature dictionaries
+    """
+    if ref["format"] == "partitioned":
+        return itertools.chain.from_iterable(iter_stored_features(store, part) for part in ref["refs"])
+    if ref["format"] == "ndjson":
+        return store.iter_records(ref)
+    with store.open_raw(ref) as infile:
+        return iter(json.load(infile)["features"])
+
+def stream_features(response):
+    """
+    - parse the features of a GeoJSON document incrementally from a file-like object
+    - falls back to parsing the whole document when ijson is not installed
+    return: iterator of feature dictionaries
+    """
+    if ijson is None:
+        return iter(json.load(response)["features"])
+    return ijson.items(response, "features.item", use_float=True)
+
+class DecodedStream:
+    """
+    - file-like reader over an http response body
+    - gzip or deflate compressed bodies are decompressed incrementally while reading,
+      so the streaming parser never holds the whole body
+    """
+    def __init__(self, response, chunk_size=65536):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.buffer = b""
+        self.eof = False
+        encoding = (response.getheader("Content-Encoding") or "").lower()
+        # wbits 32 + MAX_WBITS detects the gzip or zlib header automatically
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS) if encoding in ("gzip", "deflate") else None
+
+    def fill(self):
+        chunk = self.response.read(self.chunk_size)
+        count_metric("http_bytes_received", len(chunk))
+        if not chunk:
+            self.eof = True
+            if self.decompressor is not None:
+                self.buffer += self.decompressor.flush()
+        elif self.decompressor is not None:
+            self.buffer += self.decompressor.decompress(chunk)
+        else:
+            self.buffer += chunk
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self.fill()
+        if size < 0:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+class WowClient:
+    """
+    - client of the WOW observations api
+    - a single keep-alive connection is reused for every request of the client
+    - asks for gzip/deflate compressed bodies
+    - sends the ETag / Last-Modified validators of the previous fetch so an unchanged
+      snapshot costs a 304 response without a body
+    - retries connection errors and 429/5xx responses with exponential backoff
+    """
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url, subscription_key, retries=3, backoff=1.0, timeout=120):
+        url = urllib.parse.urlparse(base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.subscription_key = subscription_key
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = self.connection_class(self.host, self.port, timeout=self.timeout)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get(self, path, params=None, validators=None):
+        """
+        - send a (conditional) GET request
+        - the body of the response must be read before the next request of the client
+        return: tuple (DecodedStream or None when not modified, validators of the response)
+        """
+        if params:
+            path = path + "?" + urllib.parse.urlencode(params)
+        headers = {"Ocp-Apim-Subscription-Key": self.subscription_key,
+                   "Accept-Encoding": "gzip, deflate"}
+        validators = validators or {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        for attempt in range(self.retries + 1):
+            try:
+                with timed_call("http_fetch"):
+                    conn = self.connect()
+                    conn.request("GET", path, headers=headers)
+                    response = conn.getresponse()
+            except (http.client.HTTPException, OSError) as error:
+                # the connection is broken, open a new one on the next attempt
+                self.close()
+                if attempt == self.retries:
+                    raise ConnectionError("Connection FAILED:", error)
+                delay = self.backoff * 2 ** attempt
+            else:
+                if response.status == 304:
+                    response.read()
+                    count_metric("http_not_modified", 1)
+                    return None, validators
+                if response.status == 200:
+                    print("Connection status:", response.status, response.reason)
+                    return DecodedStream(response), {"etag": response.getheader("ETag"),
+                                                     "last_modified": response.getheader("Last-Modified")}
+                response.read()
+                if response.status not in self.retry_status or attempt == self.retries:
+                    raise ConnectionError("Connection FAILED:", response.status, response.reason)
+                retry_after = response.getheader("Retry-After")
+                delay = self.backoff * 2 ** attempt
+                if retry_after is not None and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            count_metric("http_retries", 1)
+            time.sleep(delay)
+
+class FetchValidatorStore:
+    """
+    - ETag / Last-Modified of the last loaded snapshot of every fetched url
+    - kept in the local state database, updated once the run is loaded
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS fetch_validators (
+                                url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)""")
+
+    def get(self, url):
+        row = self.conn.execute("SELECT etag, last_modified FROM fetch_validators WHERE url = ?", (url,)).fetchone()
+        return {} if row is None else {"etag": row[0], "last_modified": row[1]}
+
+    def update(self, validators):
+        """
+        - validators: dictionary {url: {"etag": ..., "last_modified": ...}}
+        """
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO fetch_validators VALUES (?, ?, ?)",
+                                  ((url, value.get("etag"), value.get("last_modified"))
+                                   for url, value in validators.items()))
+
+    def close(self):
+        self.conn.close()
+
+# path of the geojson observations endpoint of the WOW api
+WOW_OBSERVATIONS_PATH = "/api/observations/geojson"
+
+def partition_url(base_url, params):
+    """
+    - url of one partition (query parameters) of the observations feed, its validators are stored under it
+    return: string url
+    """
+    return base_url + WOW_OBSERVATIONS_PATH + ("?" + urllib.parse.urlencode(params) if params else "")
+
+def known_fetch_validators(base_url, partitions):
+    """
+    - read the validators of the last loaded snapshot of every partition
+    return: dictionary {url: validators}
+    """
+    validator_store = FetchValidatorStore(state_db_path())
+    known_validators = {}
+    for params in partitions:
+        url = partition_url(base_url, params)
+        known_validators[url] = validator_store.get(url)
+    validator_store.close()
+    return known_validators
+
+def fetch_settings():
+    """
+    - read the base url of the WOW api (WOW_API_URL) and the partitions of the feed
+      (WOW_FETCH_PARTITIONS, a json list of query parameters)
+    return: tuple (base_url, partitions)
+    """
+    base_url = Variable.get("WOW_API_URL", default_var="https://mowowprod.azure-api.net")
+    partitions = Variable.get("WOW_FETCH_PARTITIONS", default_var=[{}], deserialize_json=True) or [{}]
+    return base_url, partitions
+
+def wow_client(base_url):
+    """
+    - build a WOW api client with the configured subscription key and retry policy
+    return: WowClient object
+    """
+    return WowClient(base_url, Variable.get("WOW_SUBSCRIPTION_KEY"),
+                     retries=int(Variable.get("WOW_FETCH_RETRIES", default_var=3)),
+                     backoff=float(Variable.get("WOW_FETCH_BACKOFF_SECONDS", default_var=1.0)))
+
+def fetch_partition(client, params, validators, name, streaming, **context):
+    """
+    - fetch one partition (query parameters) of the observations feed with the client of the worker
+    - write it to the artifact store, feature chunk by chunk in streaming mode
+    return: tuple (reference or None when not modified, validators of the response)
+    """
+    try:
+        body, validators = client.get(WOW_OBSERVATIONS_PATH, params, validators)
+        if body is None:
+            return None, validators
+        store = get_artifact_store()
+        with timed_call("http_body"):
+            if streaming:
+                # features are written chunk by chunk while the body is still being received,
+                # memory stays bounded by one feature no matter how large the feed is
+                chunk_size = int(Variable.get("WOW_INGEST_CHUNK_SIZE", default_var=5000))
+                ref = store.write_records(stream_features(body), context["dag"].dag_id,
+                                          context["run_id"], name, chunk_size)
+            else:
+                ref = store.write_raw(body.read(), context["dag"].dag_id, context["run_id"], name + ".json")
+        return ref, validators
+    except Exception:
+        # a body left half read breaks the connection, the next partition opens a new one
+        client.close()
+        raise
+
+async def fetch_partitions(base_url, partitions, known_validators, streaming, concurrency, **context):
+    """
+    - fetch the partitions (bounding boxes or time windows) of the feed concurrently
+      in a pool of concurrency threads
+    - every thread keeps one keep-alive client, reused for all the partitions it fetches
+    return: list of (url, reference or None, validators) in partition order
+    """
+    loop = asyncio.get_running_loop()
+    local = threading.local()
+    clients = []
+
+    def fetch_in_thread(index, params, validators):
+        if getattr(local, "client", None) is None:
+            local.client = wow_client(base_url)
+            clients.append(local.client)
+        return fetch_partition(local.client, params, validators,
+                               "wow_data" if len(partitions) == 1 else "wow_data-%03d" % index, streaming, **context)
+
+    async def fetch(pool, index, params):
+        url = partition_url(base_url, params)
+        ref, validators = await loop.run_in_executor(pool, fetch_in_thread, index, params, known_validators.get(url))
+        return url, ref, validators
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        try:
+            return await asyncio.gather(*[fetch(pool, index, params) for index, params in enumerate(partitions)])
+        finally:
+            for client in clients:
+                client.close()
+
+@instrumented
 def get_data(**kwargs):
     """
-    - connect to WOW API and send query against the database
-    - read the data and parsed into a dictionary object
-    - push the raw data to airflow database in order to be access 
-       by other airflow task
+    - connect to WOW API and send (conditional, compressed) queries against the database
+    - the feed can be split in partitions (WOW_FETCH_PARTITIONS, a json list of query
+       parameters such as bounding boxes or time windows) fetched concurrently
+    - write the raw payload once to the artifact store, in streaming mode the
+       features are parsed from the response and written in fixed-size chunks
+    - push the reference of the raw payload to xcom in order to be accessed
+       by other airflow task, the run is skipped when the snapshot did not change
     """
     ti = kwargs['ti']
-    # Variable.get() extract the actual key stored in airflow database.
-    # This is for security purposes
-    headers = {"Ocp-Apim-Subscription-Key": Variable.get("WOW_SUBSCRIPTION_KEY")}
-    conn = http.client.HTTPSConnection('mowowprod.azure-api.net')
-    conn.request("GET", "/api/observations/geojson", "{body}", headers)
-    response = conn.getresponse()
-    # check if the connection was successful before proceeding
-    if (str(response.status) == "200"):
-        print("Connection status:", response.status,response.reason)
-        data = response.read()
-        conn.close()
+    base_url, partitions = fetch_settings()
+    streaming = Variable.get("WOW_STREAM_INGEST", default_var="true").lower() == "true"
+    known_validators = known_fetch_validators(base_url, partitions)
+    results = asyncio.run(fetch_partitions(base_url, partitions, known_validators, streaming,
+                                           int(Variable.get("WOW_FETCH_CONCURRENCY", default_var=4)), **kwargs))
+    refs = [ref for url, ref, validators in results if ref is not None]
+    if not refs:
+        raise AirflowSkipException("WOW observations unchanged since the last loaded snapshot")
+    if len(refs) == 1:
+        ref = refs[0]
     else:
-        raise ConnectionError("Connection FAILED:",response.status, response.reason)
-    # decode and parse the to dictionary
-    parse_data = json.loads(data)
-    # push data to xcom
-    ti.xcom_push(key="wow_data",value=parse_data)
-    print(sys.getsizeof(parse_data),"bytes of data is pushed to xcom")
-
-def extract_observations(**context):
-    """
-    - pull the raw data to extract features and values
-    - serialize the data and normalize it into flat table
-    - convert data frame into dictionary and push to the next task through xcoms
-    """
-    ti = context['ti']
-    # pull the data
-    data = ti.xcom_pull(key='wow_data')
-    print(sys.getsizeof(data), "bytes of data is pulled from xcom")
-    properties = []
-    for item in data["features"]:
-        properties.append(item["properties"])
-    # serialize dictionary object to pandas dataframe
-    df = pd.json_normalize(properties)
-    # convert dataframe to dictiory
-    # because xcoms only takes serializable object
-    json_df = df.to_json(orient="records")
-    #push dict object to xcom
-    ti.xcom_push(key='extract_observations', value=json_df)
-    print(sys.getsizeof(json_df), "bytes of data is pushed to xcom")
-
-
-def transform_observations(**context):
-    """
-    - pulls the data from the previous task
-    - convert it to pandas dataframe
-    - rename table columns and drop unwanted columns
-    - push processed table to the next task (loading data to data warehouse)
-    """
-    ti = context['ti']
-    str_df = ti.xcom_pull(key='extract_observations')
-    print(sys.getsizeof(str_df), "bytes of data is pulled from xcom")
-    # parse data
-    dict_df = json.loads(str_df)
-    # normalize dictionary object to pandas dataframe
-    df = pd.json_normalize(dict_df)
-    if ('primary.dm' and 'primary.dap' in df.columns):
-        df['primary.dm'] = df['primary.dm'].fillna(df['primary.dap'])
-        df = df.drop(columns=['primary.dap'])
-    #check if 'dap' and 'dm' in df
-    if ('primary.dap' in df.columns):
-        if ('primary.dm' not in df.columns):
-          df = df.rename(columns={'primary.dap': 'primary.dm'})
-    cols = ['reportId', 'siteId', 'primary.dt', 'primary.dpt',
-            'primary.dm', 'primary.dh', 'primary.dwd', 'primary.dws']
-    for col in df.columns:
-        if col not in cols:
-            df = df.drop(columns=[col])
-    # rename dataframe columns
-    df = df.rename(columns={'primary.dt': 'temperature', 'primary.dpt': 'dew_temperature',
-                            'primary.dws': 'wind_speed', 'primary.dm': 'mean_sea_level',
-                            'primary.dh': 'humidity', 'primary.dwd': 'wind_direction', })
-    # roundoff the values and drop nulls
-    df = df.round(1).dropna()
-    # convert dataframe to dictionary
-    json_df = df.to_json(orient="records")
-    # push dictionary object to xcom
-    ti.xcom_push(key='transform_observations', value=json_df)
-    print(sys.getsizeof(json_df), "bytes of data is pushed to xcom")
-
-def extract_location(**context):
-    """
-    - pull the raw data to extract the site location coordinates
-    - aggregate the data and create dataframe
-    - convert data frame into dictionary and push to the next task through xcoms
-    """
-    ti = context['ti']
-    data = ti.xcom_pull(key='wow_data')
-    print(sys.getsizeof(data), "bytes of data is pulled from xcom")
-    lon = []
-    lat = []
-    siteId = []
-    for item in data["features"]:
-        lon.append(item["geometry"]["coordinates"][0]) # extract longitude
-        lat.append(item["geometry"]["coordinates"][1]) # extract latitude
-        siteId.append(item["properties"])
-    # normalize dictionary to flat table
-    df1 = pd.json_normalize(siteId)
-    df2 = pd.DataFrame({"longitude": lon, "latitude": lat})
-    # join two dataframes
-    df = pd.DataFrame(df1['siteId']).join(df2)
-    json_df = df.to_json(orient="records")
-    # push to xcom
-    ti.xcom_push(key='extract_location', value=json_df)
-    
-
-def transform_location(**context):
-    """
-    - Reserve geocode coordinates into physical address
-    - create dataframe and rename table columns 
-    - push table to the loading stage
-    """
-    ti = context['ti']
-    str_df = ti.xcom_pull(key='extract_location')
-    dict_df = json.loads(str_df)
-    df = pd.DataFrame(dict_df)
-    # join the latitude and longitude columns of the dataframe
-    lat_long = [', '.join(str(x) for x in y) for y in map(
-        tuple, df[['latitude', 'longitude']].values)]
-    xy = []
-    results = []
-    for i in lat_long:
-        x = float(i.split(",")[0])  # latitute
-        y = float(i.split(",")[1])  # longitude
-        xy.append((x,y)) # create and append tuple
-
-    # reverse geocode the longitude and latitude to phsyical address (country name, city name, etc)
-    results = [rg.search(i) for i in xy]
-    #normalize the result of the reverse geocoding
-    df2 = pd.json_normalize(results)
-    # rename table columns
-    df2 = df2.rename(columns={'lat': 'latitude', 'lon': 'longitude', 'name': 'city',
-                            'admin1': 'region', 'admin2': 'local_region', 'cc': 'country_code'})
-    # join 2 dataframes horizontally
-    df = pd.DataFrame(df['siteid']).join(df2)
-    # push to xcom
-    json_df = df.to_json(orient="records")
-    ti.xcom_push(key='transform_location', value=json_df)
-
-def extract_date(**context):
-    """
-    - extract the datetime field from the data
-    - normalize to pandas dataframe
-    - push to xcom for processing
-    """
-    ti = context['ti']
-    # pull data
-    data = ti.xcom_pull(key='wow_data')
-    report_datetime = []
-    # iterate through the list of dictionaries
-    for item in data["features"]:
-        report_datetime.append(item["properties"])
-    # flatten the list of dictionaries
-    df = pd.json_normalize(report_datetime)
-    cols = ["reportId", "reportEndDateTime"]
-    # drop unwanted columns
-    for col in df.columns:
-        if col not in cols:
-            df = df.drop(columns=[col])
-    # convert dataframe to dictionary
-    json_df = df.to_json(orient="records")
-    ti.xcom_push(key='extract_date', value=json_df)
-
-def transform_datetime(**context):
-    """
-    - convert datetime into reusable format
-    - process year, month, day and time from the datetime
-    - push to xcom for loading
-    """
-    ti = context['ti']
-    str_df = ti.xcom_pull(key='extract_date')
-    dict_df = json.loads(str_df)
-    df = pd.DataFrame(dict_df)
-    df['reportEndDateTime'] = df['reportEndDateTime'].apply(convert_datetime)
-    df['date'] = df['reportEndDateTime'].dt.strftime('%Y-%m-%d')
-    df['year'] = df['reportEndDateTime'].dt.year #extract year
-    df['month'] = df['reportEndDateTime'].dt.month #extract month
-    df['day'] = df['reportEndDateTime'].dt.day
-    df['time'] = df['reportEndDateTime'].dt.time
-    df = df.drop(columns=['reportEndDateTime'])
-    json_df = df.to_json(orient="records")
-    ti.xcom_push(key='transform_date', value=json_df)
-
-def load_dataframe_to_redshift(data_frame, table_name):
-    """
-    - takes dataframe and convert it to flat file (csv)
-    - use boto3 library to connection to AWS
-    - upload the csv file to dedicated S3 bucket. S3 serves as the data lake
-    - copy the uploaded data into Redshift using the COPY command
-    """
-    # establish connection to redshift
-    pr.connect_to_redshift(dbname=Variable.get('DBNAME'),
-                            host=Variable.get('AWS_REDSHIFT_HOST'),
-                            port=Variable.get('REDSHIFT_PORT'),
-                            user=Variable.get('REDSHIFT_USER'),
-                            password=Variable.get("AWS_REDSHIFT_PWD"))
-    # establish connection to S3
-    pr.connect_to_s3(
-        aws_access_key_id=Variable.get("AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key=Variable.get("AWS_SECRET_ACCESS_KEY"),
-        bucket='wow-data-msc-project',
-        subdirectory=table_name)
-    # copy data from S3 to RedShift
-    # if append is False new table will be created if it exists or not. 
-    # Meaning it will drop existing tabel to create new one.
-    # And if it's true data inflow into the data warehouse will be on incremental basis 
-    pr.pandas_to_redshift(data_frame, table_name, column_data_types=None, index=False, save_local=False,
-                            delimiter=',', quotechar='"', dateformat='auto', timeformat='auto', region='us-east-1', append=True)
-    pr.close_up_shop()
-
-def load_observations(**context):
-    ti = context['ti']
-    # pull processed data
-    str_df = ti.xcom_pull(key='transform_observations')
-    dic_df = json.loads(str_df)
-    df = pd.DataFrame(dic_df)
-    # load dataframe to redshift
-    load_dataframe_to_redshift(data_frame=df, table_name='observations')
-    print(df.shape[0], "rows has been added to the wow_database.public.observations")
-
-
-def load_location(**context):
-    ti = context['ti']
-    str_df = ti.xcom_pull(key='extract_location')
-    dic_df = json.loads(str_df)
-    df = pd.DataFrame(dic_df)
-    load_dataframe_to_redshift(data_frame=df, table_name='location')
-    print(df.shape[0], "rows has been added to the wow_database.public.location")
-
-def load_date(**context):
-    ti = context['ti']
-    str_df = ti.xcom_pull(key='transform_date')
-    dic_df = json.loads(str_df)
-    df = pd.DataFrame(dic_df)
-    load_dataframe_to_redshift(data_frame=df, table_name='datetime')
-    print(df.shape[0], "rows has been added to the wow_database.public.datetime")
+        ref = {"format": "partitioned", "refs": refs,
+               "num_rows": sum(part.get("num_rows", 0) for part in refs),
+               "num_bytes": sum(part["num_bytes"] for part in refs)}
+    count_metric("rows_out", ref.get("num_rows", 0))
+    count_metric("bytes_written", ref["num_bytes"])
+    # push only the reference of the stored payload to xcom, the validators
+    # are recorded by commit_load_state once the snapshot is loaded
+    ti.xcom_push(key="wow_data", value=ref)
+    ti.xcom_push(key="fetch_validators", value={url: validators for url, ref, validators in results
+                                                if ref is not None})
+
+# declarative description of a warehouse column:
+#   source   - dotted path of the value in the GeoJSON feature ("properties.primary.dt",
+#              list positions are numbers: "geometry.coordinates.0")
+#   target   - name of the column in the warehouse table
+#   dtype    - dtype of the projected column (float32 for measurements, str for ids, category for
+#              repeated ids), ids are always strings so they match the TEXT keys of the state database
+#   rounding - number of decimals kept by the transform stage
+#   fallback - source path used where the source value is missing
+ColumnSpec = collections.namedtuple("ColumnSpec", ["source", "target", "dtype", "rounding", "fallback"],
+                                    defaults=[None, None])
+
+OBSERVATIONS_SCHEMA = [
+    ColumnSpec("properties.reportId", "reportId", "str"),
+    ColumnSpec("properties.siteId", "siteId", "category"),
+    ColumnSpec("properties.primary.dt", "temperature", "float32", 1),
+    ColumnSpec("properties.primary.dpt", "dew_temperature", "float32", 1),
+    # mean sea level pressure, sites which only report the air pressure fall back to it
+    ColumnSpec("properties.primary.dm", "mean_sea_level", "float32", 1, "properties.primary.dap"),
+    ColumnSpec("properties.primary.dh", "humidity", "float32", 1),
+    ColumnSpec("properties.primary.dwd", "wind_direction", "float32", 1),
+    ColumnSpec("properties.primary.dws", "wind_speed", "float32", 1),
+]
+
+LOCATION_SCHEMA = [
+    ColumnSpec("properties.siteId", "siteId", "str"),
+    ColumnSpec("geometry.coordinates.0", "longitude", "float64"),
+    ColumnSpec("geometry.coordinates.1", "latitude", "float64"),
+]
+
+DATETIME_SCHEMA = [
+    ColumnSpec("properties.reportId", "reportId", "str"),
+    ColumnSpec("properties.reportEndDateTime", "reportEndDateTime", "object"),
+]
+
+def feature_value(feature, path):
+    """
+    - follow the compiled path (tuple of keys and list positions) in the feature
+    return: the value, None when any step is missing
+    """
+    value = feature
+    for key in path:
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return value
+
+def typed_column(values, spec):
+    """
+    - build the column of spec from the projected values of its source (and fallback) path
+    return: pandas series of the spec dtype
+    """
+    column = pd.Series(values[spec.source], dtype=object)
+    if spec.fallback is not None:
+        column = column.where(column.notna(), pd.Series(values[spec.fallback], dtype=object))
+    if spec.dtype.startswith("float"):
+        return pd.to_numeric(column, errors="coerce").astype(spec.dtype)
+    if spec.dtype in ("str", "category"):
+        # numeric ids become strings, missing ids stay missing
+        column = column.where(column.isna(), column.astype(str))
+        return column if spec.dtype == "str" else column.astype("category")
+    return column.astype(spec.dtype)
 
+def project_features(features, schemas):
+    """
+    - walk the GeoJSON features once and project only the source paths used by the schemas,
+      a path shared by several tables (reportId, siteId) is read once per feature
+    - build every table straight from the projected values, with the target names and dtypes
+    return: dictionary {table_name: dataframe}
+    """
+    paths = {}
+    for schema in schemas.values():
+        for spec in schema:
+            for path in (spec.source, spec.fallback):
+                if path is not None and path not in paths:
+                    paths[path] = tuple(int(key) if key.isdigit() else key for key in path.split("."))
+    values = {path: [] for path in paths}
+    projections = [(compiled, values[path]) for path, compiled in paths.items()]
+    for feature in features:
+        for compiled, column in projections:
+            column.append(feature_value(feature, compiled))
+    return {name: pd.DataFrame({spec.target: typed_column(values, spec) for spec in schema})
+            for name, schema in schemas.items()}
+
+def round_columns(df, schema):
+    """
+    - roundoff the columns of the schema which have a rounding
+    return: dataframe
+    """
+    return df.round({spec.target: spec.rounding for spec in schema
+                     if spec.rounding is not None and spec.target in df.columns})
+
+def shard_ids(sites, shards, by="site", tile_degrees=5.0):
+    """
+    - assign rows (siteId, latitude, longitude) to one of shards partitions
+    - by "site" hashes the siteId, by "tile" hashes the geographic tile of the site
+      so neighbouring sites are handled by the same shard
+    - the hash is stable between runs and processes
+    return: numpy array of shard numbers
+    """
+    if by == "tile":
+        tiles = (np.floor(sites["latitude"] / tile_degrees).astype("int64") * 1000 +
+                 np.floor(sites["longitude"] / tile_degrees).astype("int64"))
+        keys = pd.Series(tiles.to_numpy())
+    else:
+        keys = sites["siteId"].astype(str).reset_index(drop=True)
+    return (pd.util.hash_pandas_object(keys, index=False).to_numpy() % shards).astype("int64")
+
+def extract_tables(features):
+    """
+    - project the observations, location and datetime tables of the features in one pass
+    return: tuple (observations, location, datetime), one row per feature
+    """
+    tables = project_features(features, {"observations": OBSERVATIONS_SCHEMA,
+                                         "location": LOCATION_SCHEMA,
+                                         "datetime": DATETIME_SCHEMA})
+    return tables["observations"], tables["location"], tables["datetime"]
+
+def drop_loaded(observations, location, report_datetime, state=None, loaded_sites=()):
+    """
+    - a site reports more than once per feed, its last position wins
+    - the sites of loaded_sites (already loaded by the run) are dropped
+    - with a load state store (incremental mode) the reports already loaded and the
+      sites which did not change are dropped
+    return: tuple (observations, location, datetime, keep), keep is the boolean mask of
+            the reports kept (None without load state store)
+    """
+    location = location.drop_duplicates(subset=["siteId"], keep="last")
+    location = location[~location["siteId"].isin(loaded_sites)].reset_index(drop=True)
+    keep = None
+    if state is not None:
+        keep = state.new_reports(report_datetime["reportId"], report_datetime["reportEndDateTime"])
+        observations = observations[keep].reset_index(drop=True)
+        report_datetime = report_datetime[keep].reset_index(drop=True)
+        location = location[state.changed_sites(location)].reset_index(drop=True)
+    return observations, location, report_datetime, keep
+
+@instrumented
+def extract_features(**context):
+    """
+    - pull the raw features and walk them once
+    - project the observations, location and datetime tables in the same pass
+    - in incremental mode drop the reports already loaded and the sites which did not change
+    - partition the tables in WOW_SHARDS shards by siteId hash or geographic tile (WOW_SHARD_BY)
+    - write every shard to the artifact store and push their references through xcoms
+    return: list of op_kwargs, one per shard, for the mapped transform and load tasks
+    """
+    # the features are read back lazily, chunk by chunk when ingestion was streamed
+    observations, location, report_datetime = extract_tables(pull_features(context, 'wow_data'))
+    count_metric("rows_in", len(location))
+    # observations and datetime rows follow the shard of the site which reported them
+    shards = int(Variable.get("WOW_SHARDS", default_var=4))
+    by = Variable.get("WOW_SHARD_BY", default_var="site")
+    tile_degrees = float(Variable.get("WOW_SHARD_TILE_DEGREES", default_var=5.0))
+    report_shard = shard_ids(location, shards, by, tile_degrees)
+    state = load_state_store() if incremental_mode() else None
+    try:
+        observations, location, report_datetime, keep = drop_loaded(observations, location, report_datetime, state)
+    finally:
+        if state is not None:
+            state.close()
+    if keep is not None:
+        report_shard = report_shard[keep]
+        print(int(keep.sum()), "new reports and", len(location), "new or moved sites to load")
+    site_shard = shard_ids(location, shards, by, tile_degrees)
+    refs = []
+    for shard in range(shards):
+        refs.append({
+            'extract_observations': write_table(context, shard_name('extract_observations', shard),
+                                                observations[report_shard == shard]),
+            'extract_location': write_table(context, shard_name('extract_location', shard),
+                                            location[site_shard == shard]),
+            'extract_date': write_table(context, shard_name('extract_date', shard),
+                                        report_datetime[report_shard == shard])})
+    context["ti"].xcom_push(key='extract_shards', value=refs)
+    return [{"shard": shard} for shard in range(shards)]
+
+
+def clean_observations(df):
+    """
+    - roundoff the measurements of the observations table and drop incomplete observations
+    return: dataframe
+    """
+    df = round_columns(df, OBSERVATIONS_SCHEMA).dropna()
+    if isinstance(df['siteId'].dtype, pd.CategoricalDtype):
+        # keep only the site ids of this shard in the dictionary
+        df['siteId'] = df['siteId'].cat.remove_unused_categories()
+    return df
+
+@instrumented
+def transform_observations(shard=0, **context):
+    """
+    - pulls one shard of the data from the previous task, its columns were already
+      projected, renamed and typed by OBSERVATIONS_SCHEMA during extraction
+    - roundoff the measurements and drop incomplete observations
+    - return the processed table to the next task (loading data to data warehouse)
+    """
+    df = clean_observations(pull_shard(context, 'extract_observations', shard))
+    return write_table(context, shard_name('transform_observations', shard), df)
+
+def state_db_path():
+    """
+    - path of the local sqlite database holding state kept between runs
+    return: string path
+    """
+    return Variable.get("WOW_STATE_DB", default_var="/tmp/wow_state.sqlite")
+
+def incremental_mode():
+    """
+    - check if the DAG runs in incremental mode (WOW_INCREMENTAL_LOAD variable)
+    return: boolean
+    """
+    return Variable.get("WOW_INCREMENTAL_LOAD", default_var="true").lower() == "true"
+
+def site_unchanged(merged, suffix):
+    """
+    - compare the current site coordinates with the stored ones (columns ending with suffix)
+    return: boolean series, False for new sites and sites which moved
+    """
+    return (((merged["latitude"] - merged["latitude" + suffix].astype("float64")).abs() <= 1e-6) &
+            ((merged["longitude"] - merged["longitude" + suffix].astype("float64")).abs() <= 1e-6))
+
+def select_keys(conn, table, key, values):
+    """
+    - select the rows of table whose key is one of values
+    - the values go through a temporary table joined on the key, so only the rows of the
+      incoming keys are read instead of the whole table
+    return: dataframe
+    """
+    with conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_keys (key TEXT PRIMARY KEY)")
+        conn.execute("DELETE FROM lookup_keys")
+        conn.executemany("INSERT OR IGNORE INTO lookup_keys VALUES (?)", ((str(value),) for value in values))
+        rows = pd.read_sql_query("SELECT {0}.* FROM {0} JOIN lookup_keys ON {0}.{1} = lookup_keys.key".format(table, key),
+                                 conn)
+        conn.execute("DELETE FROM lookup_keys")
+    return rows
+
+class SiteGeocodeCache:
+    """
+    - persistent siteId -> (coordinates, city, region, local_region, country_code) cache
+    - kept in the local state database so it survives between hourly runs
+    - a site is a cache miss when it is new or when its coordinates changed (site moved)
+    """
+    columns = ["siteId", "latitude", "longitude", "city", "region", "local_region", "country_code"]
+
+    def __init__(self, path):
+        # mapped transform tasks of the shards share the database
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS site_geocode (
+                                siteId TEXT PRIMARY KEY, latitude REAL, longitude REAL,
+                                city TEXT, region TEXT, local_region TEXT, country_code TEXT)""")
+
+    def lookup(self, sites):
+        """
+        - split the sites (siteId, latitude, longitude) into cached and missing ones
+        return: tuple of dataframes (hits with address columns, misses)
+        """
+        # ids are stored as text, numeric ids must match them
+        sites = sites.assign(siteId=sites["siteId"].astype(str))
+        cached = select_keys(self.conn, "site_geocode", "siteId", sites["siteId"])
+        merged = sites.merge(cached, on="siteId", how="left", suffixes=("", "_cached"))
+        # invalidate the entry of a site which moved since it was geocoded
+        hit = site_unchanged(merged, "_cached")
+        hits = merged.loc[hit, self.columns]
+        misses = sites.loc[~hit.to_numpy(), ["siteId", "latitude", "longitude"]]
+        return hits, misses
+
+    @classmethod
+    def empty(cls):
+        """
+        - sites table without rows but with the column types of a filled one, an empty shard
+          must not give object coordinates to the warehouse table
+        return: dataframe
+        """
+        return pd.DataFrame({col: pd.Series(dtype="float64" if col in ("latitude", "longitude") else object)
+                             for col in cls.columns})
+
+    def update(self, geocoded):
+        """
+        - insert or replace the address of the geocoded sites
+        """
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO site_geocode VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  geocoded[self.columns].itertuples(index=False, name=None))
+
+    def close(self):
+        self.conn.close()
+
+def report_timestamps(report_end):
+    """
+    - convert RFC3339 report end times to utc epoch seconds
+    return: float series, NaN where the time could not be parsed
+    """
+    timestamps = pd.to_datetime(report_end, utc=True, errors="coerce")
+    return (timestamps - pd.Timestamp("1970-01-01", tz="UTC")).dt.total_seconds()
+
+class LoadStateStore:
+    """
+    - local record of what was already loaded into the data warehouse
+    - reports are remembered by reportId, together with their end time so the
+      seen set can be pruned behind a high-water mark
+    - sites are remembered with their coordinates so a location is only upserted
+      when the site is new or moved
+    """
+    def __init__(self, path, retention_hours=48):
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.retention = retention_hours * 3600
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS loaded_reports (
+                                reportId TEXT PRIMARY KEY, reportEnd REAL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS loaded_sites (
+                                siteId TEXT PRIMARY KEY, latitude REAL, longitude REAL)""")
+        # the high-water mark and the pruning scan the end times
+        self.conn.execute("CREATE INDEX IF NOT EXISTS loaded_reports_end ON loaded_reports (reportEnd)")
+
+    def new_reports(self, report_id, report_end):
+        """
+        - find the reports which were not loaded yet
+        - reports older than the high-water mark minus the retention window are
+          considered loaded, they were pruned from the seen set
+        return: boolean numpy array, True for the rows to keep
+        """
+        seen = select_keys(self.conn, "loaded_reports", "reportId", report_id)["reportId"]
+        keep = ~report_id.astype(str).isin(seen)
+        watermark = self.conn.execute("SELECT MAX(reportEnd) FROM loaded_reports").fetchone()[0]
+        if watermark is not None:
+            keep &= ~(report_timestamps(report_end) < watermark - self.retention)
+        return keep.to_numpy()
+
+    def changed_sites(self, sites):
+        """
+        - find the sites (siteId, latitude, longitude) which are new or moved since their last load
+        return: boolean numpy array, True for the rows to keep
+        """
+        loaded = select_keys(self.conn, "loaded_sites", "siteId", sites["siteId"])
+        merged = sites.assign(siteId=sites["siteId"].astype(str)).merge(loaded, on="siteId", how="left", suffixes=("", "_loaded"))
+        return ~site_unchanged(merged, "_loaded").to_numpy()
+
+    def commit(self, reports, sites):
+        """
+        - record the loaded reports (reportId, reportEndDateTime) and sites
+        - prune the reports behind the high-water mark minus the retention window
+        """
+        report_end = report_timestamps(reports["reportEndDateTime"])
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO loaded_reports VALUES (?, ?)",
+                                  zip(reports["reportId"], report_end.where(report_end.notna(), None)))
+            self.conn.executemany("INSERT OR REPLACE INTO loaded_sites VALUES (?, ?, ?)",
+                                  sites[["siteId", "latitude", "longitude"]].itertuples(index=False, name=None))
+            self.conn.execute("DELETE FROM loaded_reports WHERE reportEnd < (SELECT MAX(reportEnd) FROM loaded_reports) - ?",
+                              (self.retention,))
+
+    def close(self):
+        self.conn.close()
+
+def load_state_store():
+    """
+    - open the load state store with the configured retention window
+    return: LoadStateStore object
+    """
+    return LoadStateStore(state_db_path(),
+                          retention_hours=float(Variable.get("WOW_INCREMENTAL_RETENTION_HOURS", default_var=48)))
+
+def reverse_geocode(sites):
+    """
+    - reverse geocode the coordinates of the sites into physical address
+      (city name, region, country code) with a single batched call
+    return: dataframe of the sites with the address columns
+    """
+    sites = sites.dropna(subset=["latitude", "longitude"])
+    if sites.empty:
+        return SiteGeocodeCache.empty()
+    with timed_call("geocoder"):
+        results = rg.search(list(zip(sites["latitude"], sites["longitude"])))
+    count_metric("geocoded_sites", len(results))
+    return sites.assign(city=[result["name"] for result in results],
+                        region=[result["admin1"] for result in results],
+                        local_region=[result["admin2"] for result in results],
+                        country_code=[result["cc"] for result in results])
+
+def geocode_sites(df):
+    """
+    - add the physical address of the sites, from the geocode cache or the geocoder
+    return: dataframe of the sites with the address columns
+    """
+    cache = SiteGeocodeCache(state_db_path())
+    hits, misses = cache.lookup(df)
+    geocoded = reverse_geocode(misses)
+    cache.update(geocoded)
+    cache.close()
+    count_metric("geocode_cache_hits", len(hits))
+    # join cached and newly geocoded sites
+    return pd.concat([hits, geocoded[SiteGeocodeCache.columns]], ignore_index=True)
+
+@instrumented
+def transform_location(shard=0, **context):
+    """
+    - Reserve geocode coordinates of one shard of the sites into physical address
+    - only sites missing from the geocode cache (new or moved) are sent to the geocoder
+    - return table to the loading stage
+    """
+    df = geocode_sites(pull_shard(context, 'extract_location', shard))
+    return write_table(context, shard_name('transform_location', shard), df)
+
+def datetime_table(df):
+    """
+    - build the datetime table (reportId and the dimension columns) from the reports
+    return: dataframe
+    """
+    dedupe = Variable.get("WOW_DATETIME_DEDUPE", default_var="true").lower() == "true"
+    dimension = datetime_dimension(df['reportEndDateTime'], dedupe=dedupe)
+    return pd.concat([df[['reportId']].reset_index(drop=True), dimension], axis=1)
+
+@instrumented
+def transform_datetime(shard=0, **context):
+    """
+    - convert datetime of one shard into reusable format
+    - process date, year, month, day and time from the datetime in one vectorized pass
+    - return the table for loading
+    """
+    df = datetime_table(pull_shard(context, 'extract_date', shard))
+    return write_table(context, shard_name('transform_date', shard), df)
+
+# region of the S3 bucket and the Redshift cluster
+AWS_REGION = 'us-east-1'
+
+@functools.lru_cache(maxsize=None)
+def redshift_credentials():
+    """
+    - fetch the Redshift connection variables once per process
+    return: dictionary of psycopg2 connection arguments
+    """
+    return {"dbname": Variable.get('DBNAME'),
+            "host": Variable.get('AWS_REDSHIFT_HOST'),
+            "port": Variable.get('REDSHIFT_PORT'),
+            "user": Variable.get('REDSHIFT_USER'),
+            "password": Variable.get("AWS_REDSHIFT_PWD")}
+
+@functools.lru_cache(maxsize=None)
+def aws_credentials():
+    """
+    - fetch the AWS access keys once per process
+    return: dictionary of boto3 credential arguments
+    """
+    return {"aws_access_key_id": Variable.get("AWS_ACCESS_KEY_ID"),
+            "aws_secret_access_key": Variable.get("AWS_SECRET_ACCESS_KEY")}
+
+class S3Bucket:
+    """
+    - S3 bucket holding the staged files. S3 serves as the data lake
+    - the boto3 client is created once and shared by the staging threads
+    """
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.client = boto3.client("s3", region_name=AWS_REGION, **aws_credentials())
+
+    def put(self, local_path, key):
+        # the local file is a temporary staging file, it is not needed once uploaded
+        try:
+            self.client.upload_file(local_path, self.bucket, key)
+        finally:
+            os.remove(local_path)
+        return "s3://{}/{}".format(self.bucket, key)
+
+class LocalBucket:
+    """
+    - filesystem stand-in of the S3 bucket, for running the loads without AWS
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, local_path, key):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(local_path, path)
+        return path
+
+def column_type(dtype):
+    """
+    - map a pandas dtype to the warehouse column type
+    return: string sql type
+    """
+    if pd.api.types.is_bool_dtype(dtype):
+        return "BOOLEAN"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "BIGINT"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL" if dtype.itemsize == 4 else "FLOAT"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "TIMESTAMP"
+    return "VARCHAR(256)"
+
+# staging format of each warehouse table, can be overridden with the WOW_STAGING_FORMATS variable
+#   csv     - one uncompressed csv file
+#   csv.gz  - gzip compressed csv parts of at most part_rows rows, copied in parallel
+#   parquet - compressed parquet parts of at most part_rows rows, copied in parallel
+STAGING_FORMATS = {"observations": "parquet", "location": "csv.gz", "datetime": "csv.gz"}
+
+def staged_csv_files(item):
+    """
+    - open every file of a staged table as csv text with a header line
+    - used to load the files of a local bucket into a local stand-in warehouse
+    return: iterator of text file objects
+    """
+    for uri in item["files"]:
+        if item["format"] == "parquet":
+            buffer = io.StringIO()
+            pq.read_table(uri).to_pandas().to_csv(buffer, index=False)
+            buffer.seek(0)
+            yield buffer
+        elif item["format"] == "csv.gz":
+            with gzip.open(uri, "rt", newline="") as infile:
+                yield infile
+        else:
+            with open(uri, newline="") as infile:
+                yield infile
+
+class RedshiftTarget:
+    """
+    - Redshift (or Postgres) warehouse, the connection is opened once and reused
+    - files staged in S3 are loaded with the COPY command, files staged in a local
+      bucket are streamed with COPY FROM STDIN (for a local Postgres stand-in)
+    """
+    def __init__(self):
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**redshift_credentials())
+        return self.conn
+
+    def copy_options(self, staging_format):
+        """
+        - COPY options of the staging format
+        return: string
+        """
+        if staging_format == "parquet":
+            return "FORMAT AS PARQUET"
+        options = """CSV QUOTE AS '"' IGNOREHEADER 1 DATEFORMAT 'auto' TIMEFORMAT 'auto'"""
+        return options + " GZIP" if staging_format == "csv.gz" else options
+
+    def table_columns(self, table_name):
+        """
+        - columns of an existing warehouse table, in table order
+        return: list of column names, empty when the table does not exist
+        """
+        conn = self.connect()
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""SELECT column_name FROM information_schema.columns
+                                  WHERE table_schema = current_schema() AND table_name = %s
+                                  ORDER BY ordinal_position""", (table_name.lower(),))
+                return [row[0] for row in cursor.fetchall()]
+
+    def load(self, staged):
+        """
+        - delete the rows to upsert and copy every staged table in a single transaction
+        """
+        conn = self.connect()
+        with conn:
+            with conn.cursor() as cursor:
+                for item in staged:
+                    cursor.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(item["table"], ", ".join(
+                        "{} {}".format(col, col_type) for col, col_type in item["columns"])))
+                    if item["upsert_key"] is not None and item["keys"]:
+                        cursor.execute("DELETE FROM {} WHERE {} IN %s".format(item["table"], item["upsert_key"]),
+                                       (tuple(item["keys"]),))
+                    columns = ", ".join(col for col, col_type in item["columns"])
+                    if item["uri"].startswith("s3://"):
+                        # COPY from the manifest loads all the parts (of every shard) in parallel,
+                        # parquet columns are matched by position (see WarehouseLoader.match_columns)
+                        cursor.execute("""COPY {} {} FROM '{}'
+                                          CREDENTIALS 'aws_access_key_id={};aws_secret_access_key={}'
+                                          {} MANIFEST REGION '{}'""".format(
+                            item["table"], "" if item["format"] == "parquet" else "(" + columns + ")",
+                            item["manifest"], aws_credentials()["aws_access_key_id"],
+                            aws_credentials()["aws_secret_access_key"], self.copy_options(item["format"]), AWS_REGION))
+                    else:
+                        for infile in staged_csv_files(item):
+                            cursor.copy_expert("COPY {} ({}) FROM STDIN WITH CSV HEADER".format(
+                                item["table"], columns), infile)
+
+class SQLiteTarget:
+    """
+    - SQLite stand-in of the warehouse, loads the files of a local bucket
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def table_columns(self, table_name):
+        """
+        - columns of an existing warehouse table, in table order
+        return: list of column names, empty when the table does not exist
+        """
+        return [row[1] for row in self.conn.execute("PRAGMA table_info({})".format(table_name))]
+
+    def load(self, staged):
+        """
+        - delete the rows to upsert and insert every staged table in a single transaction
+        """
+        with self.conn:
+            for item in staged:
+                self.conn.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(item["table"], ", ".join(
+                    "{} {}".format(col, col_type) for col, col_type in item["columns"])))
+                if item["upsert_key"] is not None:
+                    self.conn.executemany("DELETE FROM {} WHERE {} = ?".format(item["table"], item["upsert_key"]),
+                                          ((key,) for key in item["keys"]))
+                for infile in staged_csv_files(item):
+                    reader = csv.reader(infile)
+                    header = next(reader)
+                    # empty csv fields are nulls, like in the warehouse
+                    self.conn.executemany("INSERT INTO {} ({}) VALUES ({})".format(
+                        item["table"], ", ".join(header), ", ".join("?" * len(header))),
+                        ([value if value != "" else None for value in row] for row in reader))
+
+class WarehouseLoader:
+    """
+    - stage the tables of a run (or of one shard of a run) to the bucket concurrently,
+      in the staging format of each table
+    - then merge the staged shards and load all of them into the warehouse in one batch
+      (one transaction)
+    """
+    def __init__(self, bucket, target, formats=None, part_rows=100000, max_workers=3):
+        self.bucket = bucket
+        self.target = target
+        self.formats = STAGING_FORMATS if formats is None else formats
+        self.part_rows = part_rows
+        self.max_workers = max_workers
+
+    def write_part(self, data_frame, staging_format):
+        """
+        - write one part of a table to a local temporary file
+        return: path of the file
+        """
+        suffix = {"csv": ".csv", "csv.gz": ".csv.gz", "parquet": ".parquet"}[staging_format]
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as outfile:
+            path = outfile.name
+        if staging_format == "parquet":
+            pq.write_table(pa.Table.from_pandas(data_frame, preserve_index=False), path, compression="snappy")
+        elif staging_format == "csv.gz":
+            data_frame.to_csv(path, index=False, compression="gzip")
+        else:
+            data_frame.to_csv(path, index=False)
+        return path
+
+    def stage(self, table_name, data_frame, run_key, upsert_key=None, shard=0):
+        """
+        - write the dataframe to one or more staging files and upload them to the bucket
+        return: dictionary describing the staged table
+        """
+        staging_format = self.formats.get(table_name, "csv")
+        # plain csv is a single file, the compressed formats are split in parts
+        part_rows = max(len(data_frame), 1) if staging_format == "csv" else self.part_rows
+        prefix = "{}/{}/part-".format(table_name, run_key)
+        files = []
+        sizes = []
+        for part, start in enumerate(range(0, max(len(data_frame), 1), part_rows)):
+            path = self.write_part(data_frame.iloc[start:start + part_rows], staging_format)
+            sizes.append(os.path.getsize(path))
+            with timed_call("staging_upload"):
+                files.append(self.bucket.put(path, "{}{:03d}-{:05d}.{}".format(prefix, shard, part, staging_format)))
+            count_metric("bytes_staged", sizes[-1])
+        return {"table": table_name,
+                "uri": files[0][:files[0].rindex("part-") + len("part-")],
+                "files": files,
+                "sizes": sizes,
+                "format": staging_format,
+                "num_bytes": sum(sizes),
+                "columns": [(str(col), column_type(dtype)) for col, dtype in data_frame.dtypes.items()],
+                "num_rows": len(data_frame),
+                "upsert_key": upsert_key,
+                "keys": [] if upsert_key is None else [str(key) for key in data_frame[upsert_key].unique()]}
+
+    def match_columns(self, table_name, data_frame):
+        """
+        - parquet files are copied by column position: put the columns of the dataframe in the
+          order of the existing warehouse table (the names are compared case insensitively,
+          Redshift folds them to lower case)
+        - a table which does not exist yet is created from the dataframe, in its order
+        return: dataframe
+        """
+        if self.formats.get(table_name, "csv") != "parquet":
+            return data_frame
+        existing = self.target.table_columns(table_name)
+        if not existing:
+            return data_frame
+        by_name = {str(col).lower(): col for col in data_frame.columns}
+        if sorted(by_name) != sorted(col.lower() for col in existing):
+            raise ValueError("Columns {} do not match the columns {} of the warehouse table {}".format(
+                list(data_frame.columns), existing, table_name))
+        return data_frame[[by_name[col.lower()] for col in existing]]
+
+    def stage_tables(self, tables, run_key, shard=0):
+        """
+        - stage the tables concurrently
+        - tables: list of (table_name, dataframe, upsert_key)
+        return: list of the staged tables
+        """
+        tables = [(name, self.match_columns(name, df), upsert_key) for name, df, upsert_key in tables]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(lambda table: self.stage(table[0], table[1], run_key, table[2], shard), tables))
+
+    def merge(self, staged, run_key):
+        """
+        - merge the staged shards of each table into a single staged table
+        - for S3 a COPY manifest listing the files of every shard is uploaded
+        return: list of the merged staged tables
+        """
+        merged = {}
+        for item in staged:
+            if item["table"] not in merged:
+                merged[item["table"]] = dict(item, files=[], sizes=[], num_bytes=0, num_rows=0, keys=[])
+            table = merged[item["table"]]
+            table["files"] = table["files"] + item["files"]
+            table["sizes"] = table["sizes"] + item["sizes"]
+            table["num_bytes"] += item["num_bytes"]
+            table["num_rows"] += item["num_rows"]
+            table["keys"] = list(dict.fromkeys(table["keys"] + item["keys"]))
+        for table in merged.values():
+            if table["uri"].startswith("s3://"):
+                # parquet manifests need the size of every file
+                manifest = {"entries": [{"url": uri, "mandatory": True, "meta": {"content_length": size}}
+                                        for uri, size in zip(table["files"], table["sizes"])]}
+                with tempfile.NamedTemporaryFile("w", suffix=".manifest", delete=False) as outfile:
+                    json.dump(manifest, outfile)
+                table["manifest"] = self.bucket.put(outfile.name, "{}/{}/manifest".format(table["table"], run_key))
+        return list(merged.values())
+
+@functools.lru_cache(maxsize=None)
+def get_loader():
+    """
+    - build the warehouse loader once per process so its sessions are reused
+    - WOW_STAGING_BUCKET: "s3://wow-data-msc-project" or "file:///path" (local stand-in)
+    - WOW_WAREHOUSE: "redshift" or "sqlite:///path/to/warehouse.db" (local stand-in)
+    - WOW_STAGING_FORMATS: json object {table: "csv" | "csv.gz" | "parquet"}
+    - WOW_STAGING_PART_ROWS: maximum number of rows of a compressed part
+    return: WarehouseLoader object
+    """
+    bucket_uri = urllib.parse.urlparse(Variable.get("WOW_STAGING_BUCKET", default_var="s3://wow-data-msc-project"))
+    bucket = S3Bucket(bucket_uri.netloc) if bucket_uri.scheme == "s3" else LocalBucket(bucket_uri.path)
+    target_uri = urllib.parse.urlparse(Variable.get("WOW_WAREHOUSE", default_var="redshift"))
+    target = SQLiteTarget(target_uri.path) if target_uri.scheme == "sqlite" else RedshiftTarget()
+    formats = dict(STAGING_FORMATS)
+    formats.update(Variable.get("WOW_STAGING_FORMATS", default_var={}, deserialize_json=True))
+    return WarehouseLoader(bucket, target, formats=formats,
+                           part_rows=int(Variable.get("WOW_STAGING_PART_ROWS", default_var=100000)))
+
+def run_key(context):
+    """
+    - path safe identifier of the DAG run, used to name the staged files
+    return: string
+    """
+    return re.sub("[^A-Za-z0-9_.-]+", "_", context["run_id"])
+
+@instrumented
+def stage_tables(shard=0, **context):
+    """
+    - pull the processed observations, location and datetime tables of one shard
+    - stage the three files of the shard concurrently
+    return: list of the staged tables, copied by copy_tables
+    """
+    # in incremental mode only new or moved sites are left, replace their old rows
+    location_key = 'siteId' if incremental_mode() else None
+    tables = [('observations', pull_mapped(context, 'transform.transform_observations', shard), None),
+              ('location', pull_mapped(context, 'transform.transform_location', shard), location_key),
+              ('datetime', pull_mapped(context, 'transform.transform_datetime', shard), None)]
+    return get_loader().stage_tables(tables, run_key(context), shard)
+
+def copy_staged(loader, staged, key):
+    """
+    - merge the staged tables and copy them into the warehouse in one batch
+    """
+    merged = loader.merge(staged, key)
+    with timed_call("warehouse_copy"):
+        loader.target.load(merged)
+    for item in merged:
+        count_metric("rows_loaded", item["num_rows"])
+        print(item["num_rows"], "rows has been added to the wow_database.public." + item["table"])
+
+def record_loaded(validators, loaded):
+    """
+    - record the validators of the fetched snapshot ({url: validators})
+    - in incremental mode, record the reports and sites of the run as loaded, loaded is a
+      list of (reports, sites) artifact references committed one pair at a time
+    """
+    validator_store = FetchValidatorStore(state_db_path())
+    validator_store.update(validators)
+    validator_store.close()
+    if not incremental_mode():
+        return
+    state = load_state_store()
+    num_reports = num_sites = 0
+    for reports_ref, sites_ref in loaded:
+        reports = read_table(reports_ref, columns=['reportId', 'reportEndDateTime'])
+        sites = read_table(sites_ref)
+        state.commit(reports, sites)
+        num_reports += len(reports)
+        num_sites += len(sites)
+    state.close()
+    print(num_reports, "reports and", num_sites, "sites recorded as loaded")
+
+@instrumented
+def copy_tables(**context):
+    """
+    - merge the tables staged by every shard
+    - copy them into the warehouse in one batch
+    """
+    staged = [item for shard in context["ti"].xcom_pull(task_ids='load.stage_tables') for item in shard]
+    copy_staged(get_loader(), staged, run_key(context))
+
+@instrumented
+def commit_load_state(**context):
+    """
+    - record the reports and sites of this run as loaded, once every load task succeeded
+    - the next runs skip them in incremental mode
+    - record the validators of the fetched snapshot, the next fetch is conditional on them
+    """
+    shards = context["ti"].xcom_pull(key='extract_shards') or []
+    record_loaded(context["ti"].xcom_pull(key='fetch_validators') or {},
+                  [(refs['extract_date'], refs['extract_location']) for refs in shards])
+
+def iter_batches(records, batch_size):
+    """
+    - group an iterator of records in lists of at most batch_size records
+    return: iterator of lists
+    """
+    records = iter(records)
+    batch = list(itertools.islice(records, batch_size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(records, batch_size))
+
+def stream_partitions(base_url, partitions, known_validators, fetched):
+    """
+    - fetch the partitions of the feed one after the other on a single keep-alive client
+    - the features are parsed while the body is received, nothing is written to the artifact store
+    - the validators of every modified partition are added to fetched ({url: validators})
+    return: iterator of feature dictionaries
+    """
+    client = wow_client(base_url)
+    try:
+        for params in partitions:
+            url = partition_url(base_url, params)
+            body, validators = client.get(WOW_OBSERVATIONS_PATH, params, known_validators.get(url))
+            if body is None:
+                continue
+            fetched[url] = validators
+            # the whole body is consumed before the next request on the connection
+            yield from stream_features(body)
+    finally:
+        client.close()
+
+def transform_batch(features, loaded_sites, state=None):
+    """
+    - project one batch of features and run the three transforms on it
+    - a site is loaded once per run (loaded_sites holds the site ids of the previous
+      batches), the first batch reporting it wins
+    - the loaded reports and sites are dropped like extract_features does (drop_loaded)
+    return: tuple (observations, location, datetime, reports, sites), the last two are
+            recorded in the load state store once the run is loaded
+    """
+    observations, location, reports, keep = drop_loaded(*extract_tables(features), state, loaded_sites)
+    loaded_sites.update(location["siteId"])
+    return clean_observations(observations), geocode_sites(location), datetime_table(reports), reports, location
+
+def execution_mode(**context):
+    """
+    - choose between the staged pipeline (one task per stage and shard, tables exchanged
+      through the artifact store) and the chunked pipeline (WOW_CHUNKED_MODE variable)
+    return: task id of the first task of the chosen pipeline
+    """
+    if Variable.get("WOW_CHUNKED_MODE", default_var="false").lower() == "true":
+        return "chunked_etl"
+    return "fetch_wow_data"
+
+@instrumented
+def run_chunked_etl(**context):
+    """
+    - run fetch, extract, transform and staging as one stream of WOW_CHUNK_SIZE features:
+      every batch flows through to staging before the next one is read from the response,
+      so the peak memory is set by the batch size instead of the feed size
+    - a batch is staged while the next one is parsed and transformed
+    - the parts staged by every batch are copied into the warehouse in one batch at the end
+    - then the reports, sites and fetch validators are recorded like commit_load_state
+    - the load state and geocode cache lookups of a batch only read the ids of the batch,
+      so the cost of a batch does not grow with the size of the state database
+    """
+    base_url, partitions = fetch_settings()
+    batch_size = int(Variable.get("WOW_CHUNK_SIZE", default_var=5000))
+    fetched = {}
+    features = stream_partitions(base_url, partitions, known_fetch_validators(base_url, partitions), fetched)
+    state = load_state_store() if incremental_mode() else None
+    # in incremental mode only new or moved sites are left, replace their old rows
+    location_key = 'siteId' if state is not None else None
+    loader = get_loader()
+    key = run_key(context)
+    staged = []
+    loaded = []
+    loaded_sites = set()
+    pending = None
+    try:
+        with ThreadPoolExecutor(max_workers=1) as stager:
+            for batch, records in enumerate(iter_batches(features, batch_size)):
+                count_metric("rows_in", len(records))
+                observations, location, report_datetime, reports, sites = transform_batch(
+                    records, loaded_sites, state)
+                # the reports and sites of the batch wait in the artifact store until the copy succeeded
+                loaded.append((write_table(context, shard_name('chunked_reports', batch), reports),
+                               write_table(context, shard_name('chunked_sites', batch), sites)))
+                # at most one batch is being staged while the next one is read
+                if pending is not None:
+                    staged.extend(pending.result())
+                pending = stager.submit(loader.stage_tables, [('observations', observations, None),
+                                                              ('location', location, location_key),
+                                                              ('datetime', report_datetime, None)], key, batch)
+            if pending is not None:
+                staged.extend(pending.result())
+    finally:
+        if state is not None:
+            state.close()
+    if not fetched:
+        raise AirflowSkipException("WOW observations unchanged since the last loaded snapshot")
+    copy_staged(loader, staged, key)
+    record_loaded(fetched, loaded)
+
+@instrumented
 @provide_session
 def cleanup_xcom(session=None, **context):
     """
     This function clean all the data generated as a result of data sharing with xcom.
     If not deleted it could cause airflow to crash or slow down.
     Since the data are extracted and stored into the data warehouse. The data in the 
-    xcoms are not longer required.
+    xcoms and the artifacts they reference are not longer required.
     """
     dag = context["dag"]
     dag_id = dag._dag_id 
     #query and delete all xcom of the dag_id
     session.query(XCom).filter(XCom.dag_id == dag_id).delete()
+    # delete the stage tables written by this run
+    get_artifact_store().delete_run(dag_id, context["run_id"])
 
 with DAG(
     dag_id="WOW_data_ETL_and_data_warehouse",
@@ -299,65 +1671,61 @@ with DAG(
     tags=["Real-time ETL"]
 ) as dag:
 
+    choose_mode = BranchPythonOperator(
+        task_id="choose_execution_mode", python_callable=execution_mode,)
+    #chunked pipeline, the whole ETL streams batch by batch in a single task
+    chunked_etl = PythonOperator(
+        task_id="chunked_etl",
+        python_callable=run_chunked_etl,
+        provide_context=True,)
+    #staged pipeline
     ingest_data = PythonOperator(
         task_id="fetch_wow_data", python_callable=get_data,)
     #extraction
     with TaskGroup("extract", tooltip="extract_data") as extract:
-        extract_observation_table = PythonOperator(
-            task_id="extract_observations", 
-            python_callable=extract_observations,
-            provide_context=True,)
-        extract_location_table = PythonOperator(
-            task_id="extract_location", 
-            python_callable=extract_location,
+        extract_feature_tables = PythonOperator(
+            task_id="extract_features",
+            python_callable=extract_features,
             provide_context=True,)
-        extract_date_table = PythonOperator(
-            task_id="extract_datetime",
-            python_callable=extract_date,
-            provide_context=True,)
-        
-        extract_observation_table
-        extract_location_table
-        extract_date_table
-    #transformation
+
+        extract_feature_tables
+    #transformation, one mapped task instance per shard of the features
     with TaskGroup("transform", tooltip="transform_data") as transform:
-        transform_observation_table = PythonOperator(
+        transform_observation_table = PythonOperator.partial(
             task_id = "transform_observations",
-            python_callable=transform_observations,
-            provide_context = True,)
-        transform_location_table = PythonOperator(
+            python_callable=transform_observations,).expand(op_kwargs=extract_feature_tables.output)
+        transform_location_table = PythonOperator.partial(
             task_id="transform_location",
-            python_callable=transform_location,
-            provide_context=True,)
-        transform_datetime_table = PythonOperator(
+            python_callable=transform_location,).expand(op_kwargs=extract_feature_tables.output)
+        transform_datetime_table = PythonOperator.partial(
             task_id="transform_datetime",
-            python_callable=transform_datetime,
-            provide_context=True,)
+            python_callable=transform_datetime,).expand(op_kwargs=extract_feature_tables.output)
 
         transform_observation_table
         transform_location_table
         transform_datetime_table
-    #loading
+    #loading, every shard is staged in parallel then all the files are copied in one batch
     with TaskGroup("load", tooltip="load data to S3 and copy to RedShift") as load:
-        load_observation_table = PythonOperator(
-            task_id="load_observations", 
-            python_callable=load_observations,
-            provide_context=True,)
-        load_location_table = PythonOperator(
-            task_id="load_location", 
-            python_callable=load_location,
-            provide_context=True,)
-        load_date_table = PythonOperator(
-            task_id="load_datetime",
-            python_callable=load_date,
+        stage_shard_tables = PythonOperator.partial(
+            task_id="stage_tables",
+            python_callable=stage_tables,).expand(op_kwargs=extract_feature_tables.output)
+        copy_warehouse_tables = PythonOperator(
+            task_id="copy_tables",
+            python_callable=copy_tables,
             provide_context=True,)
 
-        load_observation_table
-        load_location_table
-        load_date_table
+        stage_shard_tables >> copy_warehouse_tables
+    commit_state = PythonOperator(
+        task_id="commit_load_state",
+        python_callable=commit_load_state,
+        provide_context=True,)
     clean_xcom = PythonOperator(
         task_id="clean_xcom",
         python_callable=cleanup_xcom,
-        provide_context=True,)
+        provide_context=True,
+        # only one of the two pipelines runs, the other one is skipped by the branch
+        trigger_rule="none_failed_min_one_success",)
 
-    ingest_data >> extract >> transform >> load >> clean_xcom
+    choose_mode >> [ingest_data, chunked_etl]
+    ingest_data >> extract >> transform >> load >> commit_state >> clean_xcom
+    chunked_etl >> clean_xcom
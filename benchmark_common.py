@@ -0,0 +1,58 @@
+# helpers shared by the benchmarks (wow_etl_benchmark.py, text_analysis_benchmark.py)
+import json
+import os
+import platform
+import resource
+import threading
+import time
+from datetime import datetime
+
+class RssSampler:
+    """
+    - sample the resident set size of the process in a background thread
+    - gives the peak memory of one stage, ru_maxrss only holds the peak of the process
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def rss(self):
+        try:
+            with open("/proc/self/statm") as infile:
+                return int(infile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # no procfs (macOS), fall back to the peak of the whole process
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self.rss()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+
+def write_results(results, output=None):
+    """
+    - print the results as json lines and append them to the output file (when given)
+    - every line carries the run metadata so results can be compared run over run
+    """
+    run = {"timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+           "python": platform.python_version(),
+           "host": platform.node(),
+           "cpus": os.cpu_count()}
+    lines = [json.dumps(dict(run, **result)) for result in results]
+    print("\n".join(lines))
+    if output:
+        with open(output, "a") as outfile:
+            outfile.write("\n".join(lines) + "\n")
@@ -1,4 +1,26 @@
 import re
+import os
+import io
+import sys
+import glob
+import time
+import json
+import argparse
+import array
+import pickle
+import functools
+from concurrent.futures import ProcessPoolExecutor
+# numpy is optional, without it the dictionary based pipeline is used
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NUM_CODES = 26 ** 3 # number of possible three-letter abbreviations
+APOSTROPHES = re.compile("'+")
+NON_LETTERS = re.compile("[^a-zA-Z]+")
+ABBREVIATION = re.compile("[A-Z]{3}")
+SHORT_NAME_LENGTH = 128 # up to this length enumerating the pairs of letters is faster than the linear scan
 
 def loadLetterValues(valuesFilePath = "values.txt"):
     """
@@ -55,10 +77,10 @@ def reformatName(name):
     
     returns: the reformatted name
     """
-    name = re.sub("'+", "", name) # remove apostrophes
-    name = re.sub("[^a-zA-Z]+", " ", name) # replace non-letter chars (inc. spaces) with spaces
+    name = APOSTROPHES.sub("", name) # remove apostrophes
+    name = NON_LETTERS.sub(" ", name) # replace non-letter chars (inc. spaces) with spaces
     name = name.title() # ensure titlecase (begginnings of words capitalised) ("\b(\w)")
-    name = re.sub(" ", "", name) # remove spaces
+    name = name.replace(" ", "") # remove spaces
     return name
 
 def createAbvs(name, letterValues):
@@ -87,14 +109,112 @@ def createAbvs(name, letterValues):
                 abvs[abv] = score
     return abvs
 
+def encodeAbv(abv):
+    """
+    Encode a three-letter abbreviation as an integer in [0, 26^3).
+
+    returns: integer code
+    """
+    return ((ord(abv[0]) - ord('A')) * 26 + ord(abv[1]) - ord('A')) * 26 + ord(abv[2]) - ord('A')
+
+def decodeAbv(code):
+    """
+    Decode an integer code made by encodeAbv() back into its abbreviation.
+
+    returns: three-letter string
+    """
+    return chr(code // 676 + ord('A')) + chr(code // 26 % 26 + ord('A')) + chr(code % 26 + ord('A'))
+
+def createAbvsLinear(name, letterValues):
+    """
+    Same output as createAbvs() (same abbreviations, scores and dictionary order) without
+    enumerating every (i, j) pair of letters, see createAbvCodes().
+    Names of up to SHORT_NAME_LENGTH characters go through createAbvs(), which is faster for them.
+
+    returns: dictionary {abbreviation: score}
+    """
+    if len(name) <= SHORT_NAME_LENGTH:
+        return createAbvs(name, letterValues)
+    return {decodeAbv(code): score for code, score in createAbvCodes(name, letterValues)}
+
+def createAbvCodes(name, letterValues):
+    """
+    Generate the abbreviations of one name as integer codes (see encodeAbv()) with their scores,
+    in the order createAbvs() inserts them in its dictionary.
+    The name is scanned once from the end while keeping, for each of the 26 letters, the lowest
+    score it has after the current position (suffix minimum), so the best score of every
+    (letter_i, letter_j) pair is found in O(26n) instead of O(n^2).
+    createAbvs() inserts an abbreviation the first time its pair is met: letter_i at its first
+    position, letter_j at its next position after that, this order is rebuilt at the end.
+    Names of up to SHORT_NAME_LENGTH letters go through createShortAbvCodes() instead, which is faster for them.
+
+    returns: list of pairs [(code, score)]
+    """
+    return createCleanAbvCodes(reformatName(name), letterValues)
+
+def createCleanAbvCodes(name, letterValues):
+    """
+    Same as createAbvCodes() for a name already cleaned by reformatName().
+
+    returns: list of pairs [(code, score)]
+    """
+    scores = calcScoresInWord(name, letterValues)
+    letters = [ord(char) - ord('A') for char in name.upper()]
+    if len(name) <= SHORT_NAME_LENGTH:
+        return createShortAbvCodes(letters, scores)
+
+    none = 1000000 # marks a letter that does not occur after the current position
+    suffixMin = [none] * 26 # suffixMin[y]: lowest score of letter y after position i
+    nextPos = [none] * 26 # nextPos[y]: next position of letter y after position i
+    present = [] # letters occurring after position i, so short names do not pay for 26 letters
+    best = {} # {x * 26 + y: lowest score}
+    firstSeen = {} # {x: (first position of x, [(nextPos[y], y) of the letters after it])}
+    for i in range(len(name) - 1, 0, -1):
+        x = letters[i]
+        if present:
+            # letter i can only be the second letter of an abbreviation if a third one follows
+            score = scores[i]
+            for y in present:
+                pairScore = score + suffixMin[y]
+                if pairScore < best.get(x * 26 + y, none):
+                    best[x * 26 + y] = pairScore
+            firstSeen[x] = (i, [(nextPos[y], y) for y in present])
+        if suffixMin[x] == none:
+            present.append(x)
+        suffixMin[x] = min(suffixMin[x], scores[i])
+        nextPos[x] = i
+
+    codes = []
+    for x, (i, following) in sorted(firstSeen.items(), key=lambda item: item[1][0]):
+        for pos, y in sorted(following):
+            codes.append(((letters[0] * 26 + x) * 26 + y, best[x * 26 + y]))
+    return codes
+
+def createShortAbvCodes(letters, scores):
+    """
+    Same pair loop as createAbvs() on integer codes, for the short names of createCleanAbvCodes()
+    (letters are the letter indexes of the cleaned name, scores its letter scores).
+    The dictionary keeps the insertion order of createAbvs().
+
+    returns: list of pairs [(code, score)]
+    """
+    abvs = {}
+    for i in range(1, len(letters) - 1):
+        prefix = (letters[0] * 26 + letters[i]) * 26
+        for j in range(i + 1, len(letters)):
+            pairScore = scores[i] + scores[j]
+            if pairScore < abvs.get(prefix + letters[j], 1000000):
+                abvs[prefix + letters[j]] = pairScore
+    return list(abvs.items())
+
 def createAllAbvs(fpath, letterValues):
     """
-    Read a file at fpath and create abbreviations for each line in it (by calling createAbvs()).
+    Read a file at fpath and create abbreviations for each line in it (by calling createAbvsLinear()).
 
     returns: list of pairs of string and dictionary: [(name, {abbreviation: score})]
     """
     with open(fpath) as infile:
-        return [(line.rstrip("\n"), createAbvs(line.rstrip("\n"), letterValues)) for line in infile]
+        return [(line.rstrip("\n"), createAbvsLinear(line.rstrip("\n"), letterValues)) for line in infile]
 
 def findDuplicates(allabvs):
     """
@@ -170,6 +290,147 @@ def chooseBestAbvs(filtered):
     """
     return [(name, chooseBestAbvsInner(abvs)) for name, abvs in filtered]
 
+def createAbvTable(fpath, letterValues):
+    """
+    Read a file at fpath and create the abbreviations of each line in it (by calling createAbvCodes())
+    as flat arrays instead of one dictionary per name: row k of the table is the abbreviation
+    codes[k] of the name names[nameIds[k]] with the score scores[k].
+    The rows of a name are contiguous and in the order createAbvs() would insert them.
+
+    returns: tuple (names, nameIds, codes, scores), names is a list and the others numpy arrays
+    """
+    with open(fpath) as infile:
+        return createAbvTableFromLines(infile, letterValues)
+
+def createAbvTableFromLines(lines, letterValues):
+    """
+    Same as createAbvTable() for any iterable of lines (open file, chunk of a file).
+
+    returns: tuple (names, nameIds, codes, scores), names is a list and the others numpy arrays
+    """
+    names = []
+    nameIds = array.array('i')
+    codes = array.array('i')
+    scores = array.array('i')
+    for line in lines:
+        name = line.rstrip("\n")
+        for code, score in createAbvCodes(name, letterValues):
+            nameIds.append(len(names))
+            codes.append(code)
+            scores.append(score)
+        names.append(name)
+    return names, np.frombuffer(nameIds, dtype=np.intc), np.frombuffer(codes, dtype=np.intc), \
+        np.frombuffer(scores, dtype=np.intc)
+
+def splitFile(fpath, numChunks):
+    """
+    Split the file at fpath into about numChunks byte ranges of similar size,
+    every range starts at the beginning of a line and ends after a newline (or at the end of the file).
+
+    returns: list of pairs [(start, end)] covering the whole file in order
+    """
+    size = os.path.getsize(fpath)
+    bounds = [0]
+    with open(fpath, 'rb') as infile:
+        for k in range(1, numChunks):
+            if k * size // numChunks <= bounds[-1]:
+                continue # the previous line was longer than a chunk
+            infile.seek(k * size // numChunks)
+            infile.readline() # move to the start of the next line
+            if infile.tell() >= size:
+                break
+            bounds.append(infile.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+def createAbvTableChunk(fpath, start, end, letterValues):
+    """
+    Worker of createAbvTableParallel(): create the abbreviation table of the lines in bytes [start, end)
+    of the file at fpath, and count the names of every code in the chunk.
+    The bytes are decoded like open() does (locale encoding, universal newlines so "\r\n" ends a line like "\n").
+
+    returns: tuple (names, nameIds, codes, scores, counts), counts is a bincount over the 26^3 codes
+    """
+    with open(fpath, 'rb') as infile:
+        infile.seek(start)
+        data = infile.read(end - start)
+    names, nameIds, codes, scores = createAbvTableFromLines(io.TextIOWrapper(io.BytesIO(data)), letterValues)
+    return names, nameIds, codes, scores, np.bincount(codes, minlength=NUM_CODES)
+
+def createAbvTableParallel(fpath, letterValues, jobs = None):
+    """
+    Parallel version of createAbvTable(): the file is split into byte ranges (splitFile()) and the
+    table of each range is created in a pool of jobs processes (all the cores by default).
+    The chunk tables are joined in input order and their code counts summed (reduce step),
+    so removeDuplicateCodes() does not need to count again.
+
+    returns: tuple (names, nameIds, codes, scores, counts)
+    """
+    jobs = jobs or os.cpu_count() or 1
+    # a few chunks per process so a slow chunk does not keep the other processes idle
+    chunks = splitFile(fpath, jobs * 4)
+    names = []
+    nameIds, codes, scores = [], [], []
+    counts = np.zeros(NUM_CODES, dtype=np.int64)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(createAbvTableChunk, [fpath] * len(chunks), [start for start, end in chunks],
+                           [end for start, end in chunks], [letterValues] * len(chunks))
+        for chunkNames, chunkNameIds, chunkCodes, chunkScores, chunkCounts in results:
+            nameIds.append(chunkNameIds + len(names)) # ids are local to their chunk
+            codes.append(chunkCodes)
+            scores.append(chunkScores)
+            counts += chunkCounts
+            names.extend(chunkNames)
+    empty = np.zeros(0, dtype=np.intc)
+    return names, np.concatenate(nameIds or [empty]).astype(np.intc), np.concatenate(codes or [empty]), \
+        np.concatenate(scores or [empty]), counts
+
+def removeDuplicateCodes(nameIds, codes, scores, counts = None):
+    """
+    Array version of findAndRemoveDuplicates(): count the names of every code with a bincount
+    (unless the counts are given) and keep the rows of the codes that belong to one name only.
+
+    returns: tuple (nameIds, codes, scores) of the unique abbreviations
+    """
+    if counts is None:
+        counts = np.bincount(codes, minlength=NUM_CODES)
+    unique = counts[codes] == 1
+    return nameIds[unique], codes[unique], scores[unique]
+
+def chooseBestAbvCodes(names, nameIds, codes, scores):
+    """
+    Array version of chooseBestAbvs(): grouped minimum of the scores per name, every row
+    reaching the minimum of its name is kept in table order (like chooseBestAbvsInner() ties).
+    Abbreviations are decoded into strings only here.
+
+    returns: list of pairs [(name, [best_abbv, ])]
+    """
+    minScores = np.full(len(names), np.iinfo(scores.dtype).max, dtype=scores.dtype)
+    np.minimum.at(minScores, nameIds, scores)
+    best = scores == minScores[nameIds]
+    bestabvs = [(name, []) for name in names]
+    for nameId, code in zip(nameIds[best].tolist(), codes[best].tolist()):
+        bestabvs[nameId][1].append(decodeAbv(code))
+    return bestabvs
+
+def chooseBestCodes(codes, counts, count):
+    """
+    Choose the lowest scored abbreviations of one name among its (code, score) pairs whose
+    counts[code] equals count, ties in createAbvs() order like chooseBestAbvsInner().
+
+    returns: list of abbreviations
+    """
+    minv = 1000000
+    out = []
+    for code, score in codes:
+        if counts[code] != count or score > minv:
+            continue
+        if score < minv:
+            out = []
+            minv = score
+        out.append(decodeAbv(code))
+    return out
+
 def writeBestAbvsToFile(bestabvs, fpath):
     """
     Writes the output of chooseBestAbvs() into a file in the format specified.
@@ -180,6 +441,418 @@ def writeBestAbvsToFile(bestabvs, fpath):
             outfile.write(f"{(' '.join(abvs))}\n") # a line with the best abbvs for the name
 
 
+def countAbvCodes(fpath, letterValues):
+    """
+    First pass of the streaming mode: read the file at fpath line by line and count the names of
+    every abbreviation code, saturating at 2 (0: unused, 1: unique, 2: duplicate).
+    Only the 26^3 counters are kept, nothing per name.
+
+    returns: bytearray of NUM_CODES counters
+    """
+    seen = bytearray(NUM_CODES)
+    with open(fpath) as infile:
+        for line in infile:
+            for code, score in createAbvCodes(line.rstrip("\n"), letterValues):
+                if seen[code] < 2:
+                    seen[code] += 1
+    return seen
+
+def writeBestAbvsStreaming(inPath, outPath, letterValues, seen, bufferSize = 1 << 20):
+    """
+    Second pass of the streaming mode: read the file at inPath again, recreate the abbreviations of
+    each name and write its best unique ones (seen[code] == 1) to outPath straight away,
+    in the format of writeBestAbvsToFile().
+
+    returns: number of names written
+    """
+    numNames = 0
+    with open(inPath) as infile, open(outPath, 'w', buffering=bufferSize) as outfile:
+        for line in infile:
+            numNames += 1
+            name = line.rstrip("\n")
+            out = chooseBestCodes(createAbvCodes(name, letterValues), seen, 1)
+            outfile.write(f"{name}\n")
+            outfile.write(f"{(' '.join(out))}\n")
+    return numNames
+
+class AbvIndex:
+    """
+    Persistent, incremental version of the whole pipeline (abbreviations, duplicate removal, best choice).
+    Keeps the number of names of every abbreviation code and the inverted map code -> names, so adding
+    or removing a name only recomputes the best abbreviations of the names whose code became
+    unique or duplicate, instead of the whole file.
+    Names are identified by the id returned by addName() (a file can contain the same name twice).
+    """
+    def __init__(self, letterValues):
+        self.letterValues = letterValues
+        self.names = {} # {nameId: name}, in insertion (file) order
+        self.abvs = {} # {nameId: [(code, score)]}, in createAbvs() order
+        self.counts = array.array('i', bytes(4 * NUM_CODES)) # counts[code]: number of names with the code
+        self.owners = {} # {code: {nameIds}}
+        self.best = {} # {nameId: [best_abbv, ]}
+        self.nextId = 0
+
+    @classmethod
+    def fromFile(cls, fpath, letterValues):
+        """
+        Build the index of every line of the file at fpath, the best abbreviations are chosen once at the end.
+
+        returns: AbvIndex object
+        """
+        with open(fpath) as infile:
+            return cls.fromNames((line.rstrip("\n") for line in infile), letterValues)
+
+    @classmethod
+    def fromNames(cls, names, letterValues):
+        """
+        Build the index of names, the best abbreviations are chosen once at the end.
+
+        returns: AbvIndex object
+        """
+        index = cls(letterValues)
+        for name in names:
+            index.addName(name, update=False)
+        for nameId in index.names:
+            index.updateBest(nameId)
+        return index
+
+    def addName(self, name, update = True, codes = None):
+        """
+        Add a name to the index. Its abbreviations that another name already has become duplicates,
+        the best abbreviations of that name are recomputed (with update).
+        codes can be given when the abbreviations of the name were already created (createAbvCodes()).
+
+        returns: id of the name
+        """
+        nameId = self.nextId
+        self.nextId += 1
+        self.names[nameId] = name
+        self.abvs[nameId] = list(createAbvCodes(name, self.letterValues) if codes is None else codes)
+        affected = set()
+        for code, score in self.abvs[nameId]:
+            self.counts[code] += 1
+            owners = self.owners.setdefault(code, set())
+            if self.counts[code] == 2:
+                # the code was unique to its other owner
+                affected.update(owners)
+            owners.add(nameId)
+        if update:
+            for otherId in affected:
+                self.updateBest(otherId)
+            self.updateBest(nameId)
+        return nameId
+
+    def removeName(self, nameId):
+        """
+        Remove a name from the index. Its abbreviations left with a single name become unique again,
+        the best abbreviations of that name are recomputed.
+        """
+        affected = set()
+        for code, score in self.abvs.pop(nameId):
+            self.counts[code] -= 1
+            owners = self.owners[code]
+            owners.discard(nameId)
+            if not owners:
+                del self.owners[code]
+            elif self.counts[code] == 1:
+                affected.update(owners)
+        del self.names[nameId]
+        # a name added without update has no best abbreviations yet
+        self.best.pop(nameId, None)
+        for otherId in affected:
+            self.updateBest(otherId)
+
+    def updateBest(self, nameId):
+        """
+        Choose the lowest scored unique abbreviations of one name, ties in createAbvs() order
+        like chooseBestAbvsInner().
+        """
+        self.best[nameId] = chooseBestCodes(self.abvs[nameId], self.counts, 1)
+
+    def bestAbvs(self, nameId):
+        """
+        returns: list of the best unique abbreviations of the name
+        """
+        return self.best[nameId]
+
+    def namesForAbv(self, abv):
+        """
+        Anything else than three upper case letters is not an abbreviation and has no names.
+
+        returns: list of the names that can be abbreviated as abv (unique or not), in insertion order
+        """
+        if not ABBREVIATION.fullmatch(abv):
+            return []
+        return [self.names[nameId] for nameId in sorted(self.owners.get(encodeAbv(abv), ()))]
+
+    def bestAbvsList(self):
+        """
+        returns: list of pairs [(name, [best_abbv, ])] in insertion order, like chooseBestAbvs()
+        """
+        return [(name, self.best[nameId]) for nameId, name in self.names.items()]
+
+    def save(self, fpath):
+        """
+        Write a snapshot of the index to the file at fpath.
+        """
+        with open(fpath, 'wb') as outfile:
+            pickle.dump(self, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, fpath):
+        """
+        Read a snapshot written by save().
+
+        returns: AbvIndex object
+        """
+        with open(fpath, 'rb') as infile:
+            return pickle.load(infile)
+
+class AbvService:
+    """
+    Long-lived, in-process query object for services (no input() or files per request).
+    Letter values are loaded once, the cleaned names and their abbreviations are kept in bounded
+    LRU caches keyed by the cleaned name, and the answers come from an AbvIndex of the known names.
+    """
+    def __init__(self, valuesFilePath = "values.txt", indexPath = None, cacheSize = 100000):
+        self.letterValues = loadLetterValues(valuesFilePath)
+        self.index = AbvIndex.load(indexPath) if indexPath else AbvIndex(self.letterValues)
+        if self.index.letterValues != self.letterValues:
+            # the snapshot was scored with other letter values, rescore its names with the loaded ones
+            self.index = AbvIndex.fromNames(self.index.names.values(), self.letterValues)
+        self.nameIds = {} # {name: [nameIds]}, a name can be in the index more than once
+        for nameId, name in self.index.names.items():
+            self.nameIds.setdefault(name, []).append(nameId)
+        self.cleanName = functools.lru_cache(maxsize=cacheSize)(reformatName)
+        self.cleanAbvCodes = functools.lru_cache(maxsize=cacheSize)(self.createCleanAbvCodes)
+
+    def createCleanAbvCodes(self, cleanName):
+        # tuple so the cached value cannot be changed by a caller
+        return tuple(createCleanAbvCodes(cleanName, self.letterValues))
+
+    def abvCodes(self, name):
+        """
+        returns: the (code, score) pairs of the name, from the caches when the cleaned name was seen before
+        """
+        return self.cleanAbvCodes(self.cleanName(name))
+
+    def addNames(self, names):
+        """
+        Add names to the index, the best abbreviations of the names they affect are updated.
+        """
+        for name in names:
+            nameId = self.index.addName(name, codes=self.abvCodes(name))
+            self.nameIds.setdefault(name, []).append(nameId)
+
+    def addFile(self, fpath):
+        """
+        Add every line of the file at fpath to the index.
+        """
+        with open(fpath) as infile:
+            self.addNames(line.rstrip("\n") for line in infile)
+
+    def removeNames(self, names):
+        """
+        Remove names (one instance of each) from the index.
+        """
+        for name in names:
+            self.index.removeName(self.nameIds[name].pop())
+            if not self.nameIds[name]:
+                del self.nameIds[name]
+
+    def bestAbvsFor(self, names):
+        """
+        Batch lookup of the best unique abbreviations of names.
+        A name in the index gets its current best abbreviations, any other name gets the best of
+        the abbreviations that no indexed name has (the ones that would be unique if it was added).
+
+        returns: list with a list of abbreviations per name
+        """
+        out = []
+        for name in names:
+            if name in self.nameIds:
+                # a copy, the list of the index must not be changed by a caller
+                out.append(list(self.index.bestAbvs(self.nameIds[name][0])))
+                continue
+            out.append(chooseBestCodes(self.abvCodes(name), self.index.counts, 0))
+        return out
+
+    def namesForAbvs(self, abvs):
+        """
+        Batch lookup of the indexed names that can be abbreviated as each of abvs (in any case),
+        an input that is not three letters gets no names.
+
+        returns: list with a list of names per abbreviation
+        """
+        # upper() can turn a non ascii letter into two ascii ones ("ß" -> "SS")
+        return [self.index.namesForAbv(abv.upper() if abv.isascii() else abv) for abv in abvs]
+
+    def save(self, indexPath):
+        """
+        Write a snapshot of the index, reloaded with AbvService(indexPath=...).
+        """
+        self.index.save(indexPath)
+
+def processFile(inPath, outPath, letterValues, mode = "array", jobs = None, timings = None):
+    """
+    Create the abbreviations of every name in the file at inPath, remove the duplicates
+    and write the best abbreviations of each name to outPath.
+    mode "array" uses the integer coded tables (needs numpy), mode "parallel" creates them
+    in jobs processes, mode "dict" uses the dictionaries of createAllAbvs(), mode "stream" reads
+    the file twice with a memory use bounded by the 26^3 abbreviations instead of the number of names.
+    All write the same file.
+    The seconds spent in each stage are added to timings ({stage: seconds}) when it is given.
+
+    returns: number of names
+    """
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        timings[stage] = timings.get(stage, 0) + now - start
+        start = now
+
+    if mode == "stream":
+        seen = countAbvCodes(inPath, letterValues)
+        lap("count")
+        numNames = writeBestAbvsStreaming(inPath, outPath, letterValues, seen)
+        lap("write")
+        return numNames
+    if mode == "parallel" and np is not None:
+        names, nameIds, codes, scores, counts = createAbvTableParallel(inPath, letterValues, jobs)
+        lap("create")
+        nameIds, codes, scores = removeDuplicateCodes(nameIds, codes, scores, counts)
+        lap("duplicates")
+        bestabvs = chooseBestAbvCodes(names, nameIds, codes, scores)
+    elif mode in ("array", "parallel") and np is not None:
+        names, nameIds, codes, scores = createAbvTable(inPath, letterValues)
+        lap("create")
+        nameIds, codes, scores = removeDuplicateCodes(nameIds, codes, scores)
+        lap("duplicates")
+        bestabvs = chooseBestAbvCodes(names, nameIds, codes, scores)
+    else:
+        allabvs = createAllAbvs(inPath, letterValues)
+        lap("create")
+        filtered = findAndRemoveDuplicates(allabvs)
+        lap("duplicates")
+        bestabvs = chooseBestAbvs(filtered)
+    lap("choose")
+    writeBestAbvsToFile(bestabvs, outPath)
+    lap("write")
+    return len(bestabvs)
+
+def outputPath(inPath, outDir = None):
+    """
+    Name of the output file of an input file, like main() does: "names.txt" -> "pavlica_names_abbrevs.txt",
+    in outDir or next to the input file.
+
+    returns: path of the output file
+    """
+    fname = os.path.basename(inPath)
+    fname = fname[:-4] if fname.endswith(".txt") else fname
+    return os.path.join(outDir or os.path.dirname(inPath), f"pavlica_{fname}_abbrevs.txt")
+
+def processBatchFile(inPath, outDir, letterValues, mode, jobs):
+    """
+    Process one file of a batch (see batchMain()) and measure it.
+    A file that cannot be read or written does not stop the batch, its error is returned instead.
+
+    returns: dictionary with the file, its output, number of names and timings (or the error)
+    """
+    timings = {}
+    start = time.perf_counter()
+    outPath = outputPath(inPath, outDir)
+    try:
+        numNames = processFile(inPath, outPath, letterValues, mode, jobs, timings)
+    except (OSError, ValueError) as e:
+        return {"file": inPath, "output": outPath, "mode": mode, "error": str(e)}
+    total = time.perf_counter() - start
+    return {"file": inPath,
+            "output": outPath,
+            "mode": mode,
+            "names": numNames,
+            "stages": {stage: round(seconds, 6) for stage, seconds in timings.items()},
+            "total_seconds": round(total, 6),
+            "names_per_second": round(numNames / total, 1) if total > 0 else None}
+
+def positiveInt(value):
+    """
+    argparse type of the options that count something, like --jobs.
+
+    returns: integer of at least 1
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+def batchMain(argv):
+    """
+    Non-interactive entry point: process many files in one process (or a pool of processes with --jobs),
+    the letter values are loaded once and shared by every file.
+    Prints a timing and throughput report of every file and stage, and writes it as json lines with --report.
+    A file that fails is reported with its error and the batch goes on, the exit status is 1 if any file failed.
+    """
+    parser = argparse.ArgumentParser(description="Create the best unique abbreviations of the names of many files")
+    parser.add_argument("inputs", nargs="*", help="name files or glob patterns (\"data/*.txt\")")
+    parser.add_argument("--manifest", help="file listing one input file (or glob pattern) per line")
+    parser.add_argument("--values", default="values.txt", help="letter values file")
+    parser.add_argument("--mode", default="array", choices=["array", "parallel", "dict", "stream"])
+    parser.add_argument("--jobs", type=positiveInt, default=1, help="number of files processed at the same time")
+    parser.add_argument("--output-dir", help="directory of the output files (next to each input by default)")
+    parser.add_argument("--report", help="append the report (json lines) to this file")
+    args = parser.parse_args(argv)
+
+    patterns = list(args.inputs)
+    if args.manifest:
+        with open(args.manifest) as manifest:
+            patterns.extend(line.strip() for line in manifest if line.strip())
+    inPaths = []
+    for pattern in patterns:
+        # a name that is not a glob pattern (or matches nothing) is kept, so a missing file shows up
+        # in the report as an error
+        inPaths.extend(sorted(glob.glob(pattern)) or [pattern])
+    # a file listed twice (by a pattern and the manifest) is processed once
+    inPaths = list(dict.fromkeys(os.path.normpath(inPath) for inPath in inPaths))
+    if not inPaths:
+        parser.error("no input files")
+    outPaths = {}
+    for inPath in inPaths:
+        outPaths.setdefault(os.path.normpath(outputPath(inPath, args.output_dir)), []).append(inPath)
+    collisions = [f"{', '.join(paths)} -> {outPath}" for outPath, paths in outPaths.items() if len(paths) > 1]
+    if collisions:
+        parser.error("input files with the same output file: " + "; ".join(collisions))
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    letterValues = loadLetterValues(args.values)
+    # the cores are shared between the files processed at the same time
+    chunkJobs = max((os.cpu_count() or 1) // args.jobs, 1)
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(processBatchFile, inPaths, [args.output_dir] * len(inPaths),
+                                    [letterValues] * len(inPaths), [args.mode] * len(inPaths),
+                                    [chunkJobs] * len(inPaths)))
+    else:
+        results = [processBatchFile(inPath, args.output_dir, letterValues, args.mode, chunkJobs) for inPath in inPaths]
+
+    failed = [result for result in results if "error" in result]
+    for result in results:
+        if "error" in result:
+            print(f"{result['file']}: failed: {result['error']}")
+            continue
+        stages = " ".join(f"{stage}={seconds:.3f}s" for stage, seconds in result["stages"].items())
+        print(f"{result['file']}: {result['names']} names in {result['total_seconds']:.3f}s "
+              f"({result['names_per_second']} names/s) {stages} -> {result['output']}")
+    totalNames = sum(result.get("names", 0) for result in results)
+    print(f"{len(results)} files, {totalNames} names, {len(failed)} failed")
+    if args.report:
+        with open(args.report, "a") as report:
+            for result in results:
+                report.write(json.dumps(result) + "\n")
+    if failed:
+        sys.exit(1)
+
 def main():
     """
     Entry point of the program, does what was specified in the brief by calling the other functions.
@@ -190,15 +863,13 @@ def main():
     # print(fname)
     letterValues = loadLetterValues()
     # print(letterValues)
-    allabvs= createAllAbvs(f"{fname}.txt", letterValues)
-    # print(allabvs)
-    filtered = findAndRemoveDuplicates(allabvs)
-    # print(filtered)
-    bestabvs = chooseBestAbvs(filtered)
-    # print(bestabvs)
-    writeBestAbvsToFile(bestabvs, f"pavlica_{fname}_abbrevs.txt")
+    processFile(f"{fname}.txt", f"pavlica_{fname}_abbrevs.txt", letterValues)
     
 
 # to enable running this file either by itself or as a module
+# with arguments it runs in batch mode (see batchMain()), without them it asks for one file like before
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        batchMain(sys.argv[1:])
+    else:
+        main()
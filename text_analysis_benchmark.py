@@ -0,0 +1,177 @@
+# benchmark of the abbreviation pipeline (text_analysis_app.py) on synthetic name corpora
+#   python text_analysis_benchmark.py --names 1000 100000 1000000
+#   python text_analysis_benchmark.py --names 10000000 --engines stream parallel --no-stages
+import argparse
+import filecmp
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+import text_analysis_app as ta
+from benchmark_common import RssSampler, write_results
+
+ENGINES = ["dict", "array", "parallel", "stream", "index"] # modes of processFile(), and the AbvIndex
+
+def writeSyntheticCorpus(fpath, numNames, wordLength = 6, punctuation = 0.05, duplicateRate = 0.01, seed = 0):
+    """
+    Write a file of numNames names, one per line, line by line so large corpora fit in memory.
+    Names have 1 to 4 words of 1 to 2 * wordLength letters, in random case.
+    punctuation is the probability of an apostrophe, hyphen, dot or digit after each letter, and
+    duplicateRate the probability of a line repeating one of the recent names.
+    """
+    rng = random.Random(seed)
+    recent = [] # recent names that can be repeated
+    with open(fpath, 'w') as outfile:
+        for k in range(numNames):
+            if recent and rng.random() < duplicateRate:
+                name = rng.choice(recent)
+            else:
+                words = []
+                for w in range(rng.randint(1, 4)):
+                    word = []
+                    for c in range(rng.randint(1, 2 * wordLength)):
+                        word.append(rng.choice(string.ascii_letters))
+                        if rng.random() < punctuation:
+                            word.append(rng.choice("'-.0123456789"))
+                    words.append("".join(word))
+                name = " ".join(words)
+                if len(recent) < 1000:
+                    recent.append(name)
+                else:
+                    recent[rng.randrange(1000)] = name
+            outfile.write(f"{name}\n")
+
+def writeSyntheticValues(fpath, seed = 0):
+    """
+    Write a values.txt-like file (letter, score per line) with scores in [1, 25].
+    """
+    rng = random.Random(seed)
+    with open(fpath, 'w') as outfile:
+        for letter in string.ascii_uppercase:
+            outfile.write(f"{letter} {rng.randint(1, 25)}\n")
+
+def timeStage(stage, numNames, function, *args):
+    """
+    Run function(*args) once and measure it.
+
+    returns: pair (result of the function, dictionary of the measures)
+    """
+    with RssSampler() as sampler:
+        startWall = time.perf_counter()
+        startCpu = time.process_time()
+        value = function(*args)
+        wall = time.perf_counter() - startWall
+        cpu = time.process_time() - startCpu
+    return value, {"stage": stage,
+                   "wall_seconds": round(wall, 6),
+                   "cpu_seconds": round(cpu, 6),
+                   "names_per_second": round(numNames / wall, 1) if wall > 0 else None,
+                   "peak_rss_bytes": sampler.peak}
+
+def benchmarkStages(corpusPath, letterValues, oraclePath):
+    """
+    Time every stage of the original implementation (createAbvs() and the dictionary pipeline)
+    over the corpus, the file it writes is the oracle the engines are checked against.
+
+    returns: list of result dictionaries, one per stage
+    """
+    with open(corpusPath) as infile:
+        names = [line.rstrip("\n") for line in infile]
+    results = []
+    cleaned, result = timeStage("reformatName", len(names), lambda: [ta.reformatName(name) for name in names])
+    results.append(result)
+    scores, result = timeStage("calcScoresInWord", len(names),
+                               lambda cleaned: [ta.calcScoresInWord(name, letterValues) for name in cleaned], cleaned)
+    results.append(result)
+    del cleaned, scores
+    allabvs, result = timeStage("createAbvs", len(names),
+                                lambda: [(name, ta.createAbvs(name, letterValues)) for name in names])
+    results.append(result)
+    linear, result = timeStage("createAbvsLinear", len(names),
+                               lambda: [(name, ta.createAbvsLinear(name, letterValues)) for name in names])
+    results.append(result)
+    del linear
+    dupes, result = timeStage("findDuplicates", len(names), ta.findDuplicates, allabvs)
+    results.append(result)
+    filtered, result = timeStage("removeDuplicates", len(names), ta.removeDuplicates, allabvs, dupes)
+    results.append(result)
+    del allabvs
+    bestabvs, result = timeStage("chooseBestAbvs", len(names), ta.chooseBestAbvs, filtered)
+    results.append(result)
+    value, result = timeStage("writeBestAbvsToFile", len(names), ta.writeBestAbvsToFile, bestabvs, oraclePath)
+    results.append(result)
+    return results
+
+def processIndex(corpusPath, outPath, letterValues):
+    """
+    Build an AbvIndex of the corpus and write its best abbreviations like processFile() does.
+    """
+    ta.writeBestAbvsToFile(ta.AbvIndex.fromFile(corpusPath, letterValues).bestAbvsList(), outPath)
+
+def benchmarkEngine(engine, corpusPath, numNames, letterValues, outPath, oraclePath, jobs = None):
+    """
+    Time one processFile() mode (or the AbvIndex with the "index" engine) end to end,
+    and compare its output with the oracle file (when there is one).
+
+    returns: result dictionary
+    """
+    if engine == "index":
+        value, result = timeStage("AbvIndex", numNames, processIndex, corpusPath, outPath, letterValues)
+    else:
+        value, result = timeStage("processFile", numNames, ta.processFile, corpusPath, outPath, letterValues,
+                                  engine, jobs)
+    result["engine"] = engine
+    result["matches_oracle"] = filecmp.cmp(outPath, oraclePath, shallow=False) if os.path.exists(oraclePath) else None
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the abbreviation pipeline on synthetic name corpora")
+    parser.add_argument("--names", type=int, nargs="+", default=[1000, 100000],
+                        help="number of names of the synthetic corpora")
+    parser.add_argument("--word-length", type=int, default=6, help="average number of letters of a word")
+    parser.add_argument("--punctuation", type=float, default=0.05,
+                        help="probability of an apostrophe, hyphen, dot or digit after a letter")
+    parser.add_argument("--duplicate-rate", type=float, default=0.01, help="probability of a repeated name")
+    parser.add_argument("--engines", nargs="+", default=ENGINES, choices=ENGINES)
+    parser.add_argument("--jobs", type=int, help="processes of the parallel engine (all the cores by default)")
+    parser.add_argument("--values", help="letter values file (synthetic values by default)")
+    parser.add_argument("--no-stages", action="store_true",
+                        help="skip the per-stage timing of the original implementation (and the oracle check)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the results (json lines) to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="abbrevs_benchmark_")
+    valuesPath = args.values
+    if valuesPath is None:
+        valuesPath = os.path.join(workdir, "values.txt")
+        writeSyntheticValues(valuesPath, args.seed)
+    letterValues = ta.loadLetterValues(valuesPath)
+    results = []
+    for numNames in args.names:
+        corpus = {"names": numNames, "word_length": args.word_length,
+                  "punctuation": args.punctuation, "duplicate_rate": args.duplicate_rate}
+        corpusPath = os.path.join(workdir, f"names_{numNames}.txt")
+        writeSyntheticCorpus(corpusPath, numNames, args.word_length, args.punctuation, args.duplicate_rate, args.seed)
+        oraclePath = os.path.join(workdir, f"oracle_{numNames}.txt")
+        if not args.no_stages:
+            results.extend(dict(corpus, benchmark="stages", **result)
+                           for result in benchmarkStages(corpusPath, letterValues, oraclePath))
+        for engine in args.engines:
+            result = benchmarkEngine(engine, corpusPath, numNames, letterValues,
+                                     os.path.join(workdir, f"{engine}_{numNames}.txt"), oraclePath, args.jobs)
+            results.append(dict(corpus, benchmark="engines", **result))
+        for fname in os.listdir(workdir):
+            if fname != "values.txt":
+                os.remove(os.path.join(workdir, fname))
+    shutil.rmtree(workdir, ignore_errors=True)
+    write_results(results, args.output)
+
+    if any(result.get("matches_oracle") is False for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# benchmark of the WOW ETL pipeline (airflow_project.py)
+# runs fully offline: artifacts, staging bucket and warehouse are local stand-ins
+#   python wow_etl_benchmark.py stages --features 10000 100000 1000000
+#   python wow_etl_benchmark.py staging --rows 10000 100000
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import airflow_project as ap
+from benchmark_common import RssSampler, write_results
+
+def write_synthetic_feed(path, features, seed=0):
+    """
+    - write a WOW shaped GeoJSON feed (FeatureCollection) of features to path
+    - the document is written feature by feature so large feeds fit in memory
+    - the pressure variants handled by transform_observations are all present:
+      only primary.dm, only primary.dap, both of them and none of them
+    """
+    rng = np.random.default_rng(seed)
+    sites = max(features // 4, 1)
+    site_lat = rng.uniform(49, 61, sites)
+    site_lon = rng.uniform(-11, 2, sites)
+    with open(path, "w") as outfile:
+        outfile.write('{"type": "FeatureCollection", "features": [')
+        for start in range(0, features, 10000):
+            count = min(10000, features - start)
+            site = rng.integers(0, sites, count)
+            minute = rng.integers(0, 60, count)
+            variant = rng.integers(0, 6, count)
+            values = rng.normal(0, 1, (count, 6))
+            for i in range(count):
+                primary = {"dt": round(12 + 8 * values[i, 0], 2),
+                           "dpt": round(8 + 6 * values[i, 1], 2),
+                           "dh": round(min(max(70 + 20 * values[i, 2], 0), 100), 2),
+                           "dwd": round(180 + 90 * values[i, 3], 2),
+                           "dws": round(abs(5 + 3 * values[i, 4]), 2)}
+                pressure = round(1013 + 10 * values[i, 5], 2)
+                if variant[i] in (0, 1, 4):
+                    primary["dm"] = pressure
+                if variant[i] in (2, 3, 4):
+                    primary["dap"] = pressure + 0.5
+                feature = {"type": "Feature",
+                           "geometry": {"type": "Point",
+                                        "coordinates": [float(site_lon[site[i]]), float(site_lat[site[i]])]},
+                           "properties": {"reportId": "report-%09d" % (start + i),
+                                          "siteId": "site-%07d" % site[i],
+                                          "reportEndDateTime": "2022-07-28T10:%02d:00+00:00" % minute[i],
+                                          "isOfficial": bool(variant[i] == 0),
+                                          "primary": primary}}
+                if start + i:
+                    outfile.write(",")
+                outfile.write(json.dumps(feature))
+        outfile.write("]}")
+
+class FakeDag:
+    dag_id = "WOW_data_ETL_and_data_warehouse"
+    _dag_id = dag_id
+
+class FakeTaskInstance:
+    """
+    - in-memory stand-in of the airflow task instance and its xcom table
+    - values are keyed by (task_id, map_index, key) like the airflow xcom table
+    """
+    def __init__(self):
+        self.xcom = {}
+        self.task_id = None
+        self.map_index = -1
+
+    def xcom_push(self, key, value):
+        self.xcom[(self.task_id, self.map_index, key)] = value
+
+    def xcom_pull(self, key="return_value", task_ids=None, map_indexes=None):
+        if task_ids is None:
+            # like airflow, without task_ids any task of the run matches
+            matches = [value for (task_id, map_index, item_key), value in self.xcom.items() if item_key == key]
+            return matches[-1] if matches else None
+        if map_indexes is None:
+            matches = sorted((map_index, value) for (task_id, map_index, item_key), value in self.xcom.items()
+                             if task_id == task_ids and item_key == key)
+            if len(matches) == 1 and matches[0][0] == -1:
+                return matches[0][1]
+            return [value for map_index, value in matches]
+        return self.xcom.get((task_ids, map_indexes, key))
+
+def read_stage_metrics(path):
+    """
+    - sum the metrics emitted by the instrumented callables (every shard) per stage
+    return: dictionary {stage: {metric: value}}
+    """
+    totals = {}
+    if not os.path.exists(path):
+        return totals
+    with open(path) as infile:
+        for line in infile:
+            record = json.loads(line)
+            stage = totals.setdefault(record["stage"], {})
+            for name, value in record.items():
+                if name in ("stage", "shard", "run_id", "status", "wall_seconds", "peak_rss_bytes"):
+                    continue
+                stage[name] = round(stage.get(name, 0) + value, 6)
+    return totals
+
+def run_stage(ti, context, task_id, callable, features, results, map_indexes=(-1,)):
+    """
+    - run the callable of one DAG task (every mapped instance of it) through the fake task instance
+    - record wall time, throughput and peak RSS of the stage
+    """
+    with RssSampler() as sampler:
+        start = time.perf_counter()
+        for map_index in map_indexes:
+            ti.task_id = task_id
+            ti.map_index = map_index
+            kwargs = {} if map_index == -1 else {"shard": map_index}
+            value = callable(**kwargs, **context)
+            if value is not None:
+                ti.xcom_push("return_value", value)
+        wall_time = time.perf_counter() - start
+    results.append({"stage": task_id,
+                    "task_instances": len(map_indexes),
+                    "wall_seconds": round(wall_time, 4),
+                    "features_per_second": round(features / wall_time, 1) if wall_time else None,
+                    "peak_rss_bytes": sampler.peak})
+
+def benchmark_stages(features, shards, workdir, chunk_size=5000):
+    """
+    - generate a synthetic feed and drive every stage of the DAG on it offline
+    return: list of per stage results
+    """
+    run_dir = tempfile.mkdtemp(dir=workdir)
+    feed_path = os.path.join(run_dir, "feed.json")
+    write_synthetic_feed(feed_path, features)
+    # airflow reads AIRFLOW_VAR_<NAME> environment variables before the metadata database
+    os.environ.update({"AIRFLOW_VAR_WOW_ARTIFACT_STORE": "file://" + os.path.join(run_dir, "artifacts"),
+                       "AIRFLOW_VAR_WOW_STATE_DB": os.path.join(run_dir, "state.sqlite"),
+                       "AIRFLOW_VAR_WOW_STAGING_BUCKET": "file://" + os.path.join(run_dir, "bucket"),
+                       "AIRFLOW_VAR_WOW_WAREHOUSE": "sqlite://" + os.path.join(run_dir, "warehouse.db"),
+                       "AIRFLOW_VAR_WOW_SHARDS": str(shards),
+                       # the instrumented callables report cpu time, rows, bytes and call latency here
+                       "AIRFLOW_VAR_WOW_METRICS_SINKS": "file://" + os.path.join(run_dir, "metrics.jsonl")})
+    ap.get_loader.cache_clear()
+    ti = FakeTaskInstance()
+    context = {"ti": ti, "dag": FakeDag(), "run_id": "benchmark__%d" % features}
+    results = []
+
+    def ingest(**context):
+        # get_data without the network: stream the feed file into the artifact store
+        with open(feed_path, "rb") as infile:
+            ref = ap.get_artifact_store().write_records(ap.stream_features(infile), FakeDag.dag_id,
+                                                        context["run_id"], "wow_data", chunk_size)
+        context["ti"].xcom_push(key="wow_data", value=ref)
+
+    mapped = tuple(range(shards))
+    run_stage(ti, context, "fetch_wow_data", ingest, features, results)
+    run_stage(ti, context, "extract.extract_features", ap.extract_features, features, results)
+    run_stage(ti, context, "transform.transform_observations", ap.transform_observations, features, results, mapped)
+    run_stage(ti, context, "transform.transform_location", ap.transform_location, features, results, mapped)
+    run_stage(ti, context, "transform.transform_datetime", ap.transform_datetime, features, results, mapped)
+    run_stage(ti, context, "load.stage_tables", ap.stage_tables, features, results, mapped)
+    run_stage(ti, context, "load.copy_tables", ap.copy_tables, features, results)
+    run_stage(ti, context, "commit_load_state", ap.commit_load_state, features, results)
+    ap.get_loader().target.conn.close()
+    ap.get_loader.cache_clear()
+    stage_metrics = read_stage_metrics(os.path.join(run_dir, "metrics.jsonl"))
+    shutil.rmtree(run_dir, ignore_errors=True)
+    for result in results:
+        result.update({"benchmark": "stages", "features": features, "shards": shards})
+        result.update(stage_metrics.get(result["stage"].split(".")[-1], {}))
+    return results
+
+def synthetic_tables(rows, seed=0):
+    """
+    - build observations, location and datetime tables shaped like the transform outputs
+    return: dictionary {table_name: dataframe}
+    """
+    rng = np.random.default_rng(seed)
+    sites = max(rows // 4, 1)
+    report_id = np.array(["report-%09d" % i for i in range(rows)], dtype=object)
+    site_id = np.array(["site-%07d" % i for i in rng.integers(0, sites, rows)], dtype=object)
+    observations = pd.DataFrame({"reportId": report_id,
+                                 "siteId": site_id,
+                                 "temperature": rng.normal(12, 8, rows).round(1),
+                                 "dew_temperature": rng.normal(8, 6, rows).round(1),
+                                 "humidity": rng.uniform(20, 100, rows).round(1),
+                                 "wind_direction": rng.uniform(0, 360, rows).round(1),
+                                 "wind_speed": rng.gamma(2, 3, rows).round(1),
+                                 "mean_sea_level": rng.normal(1013, 10, rows).round(1)})
+    location = pd.DataFrame({"siteId": ["site-%07d" % i for i in range(sites)],
+                             "latitude": rng.uniform(49, 61, sites),
+                             "longitude": rng.uniform(-11, 2, sites),
+                             "city": rng.choice(["Dundee", "Perth", "Leeds", "Exeter"], sites),
+                             "region": rng.choice(["Scotland", "England"], sites),
+                             "local_region": rng.choice(["Angus", "Fife", "Devon"], sites),
+                             "country_code": "GB"})
+    end = pd.Timestamp("2022-07-28") + pd.to_timedelta(rng.integers(0, 3600, rows) * 60, unit="s")
+    report_datetime = pd.DataFrame({"reportId": report_id,
+                                    "date": end.strftime("%Y-%m-%d"),
+                                    "year": end.year,
+                                    "month": end.month,
+                                    "day": end.day,
+                                    "time": end.strftime("%H:%M:%S")})
+    return {"observations": observations, "location": location, "datetime": report_datetime}
+
+def benchmark_staging(rows, staging_format, part_rows, workdir):
+    """
+    - stage and load the synthetic tables with one staging format for every table
+    return: dictionary of bytes written and wall times
+    """
+    tables = synthetic_tables(rows)
+    run_dir = tempfile.mkdtemp(dir=workdir)
+    loader = ap.WarehouseLoader(ap.LocalBucket(os.path.join(run_dir, "bucket")),
+                                ap.SQLiteTarget(os.path.join(run_dir, "warehouse.db")),
+                                formats={name: staging_format for name in tables},
+                                part_rows=part_rows)
+    start = time.perf_counter()
+    staged = [loader.stage(name, df, "benchmark") for name, df in tables.items()]
+    stage_time = time.perf_counter() - start
+    start = time.perf_counter()
+    loader.target.load(staged)
+    load_time = time.perf_counter() - start
+    loader.target.conn.close()
+    shutil.rmtree(run_dir, ignore_errors=True)
+    return {"benchmark": "staging",
+            "format": staging_format,
+            "rows": rows,
+            "bytes_written": sum(item["num_bytes"] for item in staged),
+            "files": sum(len(item["files"]) for item in staged),
+            "stage_seconds": round(stage_time, 4),
+            "load_seconds": round(load_time, 4),
+            "total_seconds": round(stage_time + load_time, 4)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the WOW ETL stages")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    stages = subparsers.add_parser("stages", help="drive every DAG stage on synthetic GeoJSON feeds")
+    stages.add_argument("--features", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="number of features of the synthetic feeds")
+    stages.add_argument("--shards", type=int, default=4)
+    staging = subparsers.add_parser("staging", help="compare the staging formats of the loader")
+    staging.add_argument("--rows", type=int, nargs="+", default=[10000, 100000],
+                         help="number of observation rows")
+    staging.add_argument("--formats", nargs="+", default=["csv", "csv.gz", "parquet"],
+                         help="staging formats to compare, csv is the baseline")
+    staging.add_argument("--part-rows", type=int, default=100000)
+    for subparser in (stages, staging):
+        subparser.add_argument("--output", help="append the results (json lines) to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="wow_benchmark_")
+    results = []
+    if args.benchmark == "stages":
+        for features in args.features:
+            results.extend(benchmark_stages(features, args.shards, workdir))
+    else:
+        for rows in args.rows:
+            baseline = None
+            for staging_format in args.formats:
+                result = benchmark_staging(rows, staging_format, args.part_rows, workdir)
+                if staging_format == "csv":
+                    baseline = result
+                if baseline is not None:
+                    result["bytes_vs_csv"] = round(result["bytes_written"] / baseline["bytes_written"], 4)
+                    result["time_vs_csv"] = round(result["total_seconds"] / baseline["total_seconds"], 4)
+                results.append(result)
+    shutil.rmtree(workdir, ignore_errors=True)
+    write_results(results, args.output)
+
+if __name__ == "__main__":
+    main()